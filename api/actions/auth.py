@@ -1,34 +1,164 @@
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.security import OAuth2PasswordBearer
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import jwt, JWTError
+from prometheus_client import REGISTRY
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 import settings
+from cache import TTLCache, on_invalidate, on_flush
 from db.dals import UserDAL
-from db.models import User
-from db.session import get_db
+from db.entity_cache import EntityCache, MemoryEntityCacheBackend, UserSnapshot
+from db.models import User, PortalRole
+from db.session import get_db, transaction, set_writer
+from security import create_access_token
 
 from hashing import Hasher
+from metrics import CacheStatsCollector
+from rate_limit import RateLimiter, MemoryRateLimitBackend
 
 login_router = APIRouter()
 
+# login -> UserSnapshot of the current user, evicted by every write to that user
+principal_cache = EntityCache(
+    "user",
+    MemoryEntityCacheBackend(maxsize=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL_SECONDS),
+)
+REGISTRY.register(CacheStatsCollector({"principal": principal_cache.backend.stats}))
 
-async def _get_user_by_login_for_auth(login: str, db: AsyncSession):
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            return await user_dal.get_user_by_login(
-                login=login,
-            )
+login_rate_limiter = RateLimiter(MemoryRateLimitBackend(maxsize=settings.LOGIN_RATE_LIMIT_MAX_KEYS))
+
+# access token -> verified claims, every entry expires with its token
+verified_token_cache = TTLCache(
+    maxsize=settings.VERIFIED_TOKEN_CACHE_SIZE, ttl=settings.VERIFIED_TOKEN_CACHE_TTL_SECONDS
+)
+REFRESH_TOKEN_TYPE = "refresh"
+
+# user_id -> token_version, REVOKED for missing or deactivated users
+token_version_cache = TTLCache(
+    maxsize=settings.TOKEN_VERSION_CACHE_SIZE, ttl=settings.TOKEN_VERSION_CACHE_TTL_SECONDS
+)
+on_invalidate("user", token_version_cache.delete)
+on_flush(token_version_cache.clear)
+REVOKED = -1
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The current user as signed into a stateless token, built without a query."""
+
+    user_id: UUID
+    login: str
+    roles: tuple[str, ...]
+    is_active: bool = True
+
+    @property
+    def is_superuser(self) -> bool:
+        return PortalRole.ROLE_PORTAL_SUPERUSER in self.roles
+
+    @property
+    def is_admin(self) -> bool:
+        return PortalRole.ROLE_PORTAL_ADMIN in self.roles
+
+
+def access_token_claims(user: User) -> tuple[dict, timedelta]:
+    """Claims and lifetime of an access token for ``user`` in the configured TOKEN_MODE."""
+    if settings.TOKEN_MODE == "stateless":
+        claims = {
+            "sub": user.login,
+            "uid": str(user.user_id),
+            "roles": list(user.roles),
+            "ver": user.token_version,
+        }
+        return claims, timedelta(minutes=settings.STATELESS_ACCESS_TOKEN_EXPIRE_MINUTES)
+    return {"sub": user.login}, timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+
+
+async def _get_user_by_login_for_auth(login: str, db: AsyncSession) -> UserSnapshot | None:
+    # Committed before the handler runs, a 401/403 shouldn't leave the
+    # connection idle in a transaction.
+    async with transaction(db) as session:
+        user = await UserDAL(session).get_user_by_login(login=login)
+    if user is not None:
+        return UserSnapshot.from_model(user)
+
+
+def _decode_access_token(token: str) -> dict:
+    """Verified claims of an access token, a token already verified once isn't decoded again until ``exp``."""
+    payload = verified_token_cache.get(token)
+    if payload is not None:
+        return payload
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    if payload.get("typ") == REFRESH_TOKEN_TYPE:
+        raise JWTError("Refresh tokens can't be used for access")
+    ttl = payload["exp"] - time.time() if "exp" in payload else None
+    verified_token_cache.set(token, payload, ttl=ttl)
+    return payload
+
+
+def create_refresh_token(user: User) -> str:
+    claims = {"sub": user.login, "uid": str(user.user_id), "ver": user.token_version, "typ": REFRESH_TOKEN_TYPE}
+    return create_access_token(claims, expires_delta=timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS))
+
+
+async def authenticate_refresh_token(refresh_token: str, db: AsyncSession) -> User | None:
+    """User behind a valid refresh token, None when it is invalid, expired or revoked.
+
+    No password is checked, a token is revoked when the user's token_version changes.
+    """
+    try:
+        payload = jwt.decode(refresh_token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except JWTError:
+        return
+    if payload.get("typ") != REFRESH_TOKEN_TYPE:
+        return
+    async with transaction(db) as session:
+        user = await UserDAL(session).get_user_by_id(user_id=UUID(payload["uid"]))
+    if user is None or not user.is_active or user.token_version != payload["ver"]:
+        return
+    return user
+
+
+async def _get_token_version(user_id: UUID, db: AsyncSession) -> int:
+    version = token_version_cache.get(user_id)
+    if version is not None:
+        return version
+    async with transaction(db) as session:
+        version = await UserDAL(session).get_token_version(user_id)
+    version = REVOKED if version is None else version
+    token_version_cache.set(user_id, version)
+    return version
+
+
+async def throttle_login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    """Reject a login attempt over the per-login or per-IP limit, before the user lookup and bcrypt."""
+    if not settings.LOGIN_RATE_LIMIT_ENABLED:
+        return
+    window = settings.LOGIN_RATE_LIMIT_WINDOW_SECONDS
+    retry_after = await login_rate_limiter.check([
+        (("login", form_data.username), settings.LOGIN_RATE_LIMIT_PER_LOGIN, window),
+        (("ip", request.client.host if request.client else None), settings.LOGIN_RATE_LIMIT_PER_IP, window),
+    ])
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(retry_after)},
+        )
 
 
 async def authenticate_user(login: str, password: str, db: AsyncSession) -> User | None:
-    user = await _get_user_by_login_for_auth(login=login, db=db)
+    # Commit before verifying, the connection shouldn't be held while bcrypt runs.
+    async with transaction(db) as session:
+        user = await UserDAL(session).get_user_by_login(login=login)
     if user is None:
         return
-    if not Hasher.verify_password(password, user.hashed_password):
+    if not await Hasher.verify_password_async(password, user.hashed_password):
         return
     return user
 
@@ -42,18 +172,30 @@ async def get_current_user_from_token(token: str = Depends(oauth2_scheme), db:As
         detail="Could not validate credentials"
     )
     try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
-        )
+        payload = _decode_access_token(token)
         username: str = payload.get("sub")
         print(f"username/login extracted is {username}")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+    set_writer(db, token)
+    if settings.TOKEN_MODE == "stateless" and "uid" in payload:
+        principal = Principal(user_id=UUID(payload["uid"]), login=username, roles=tuple(payload["roles"]))
+        if await _get_token_version(principal.user_id, db) != payload["ver"]:
+            raise credentials_exception
+        return principal
+    user = principal_cache.backend.get(username)
+    if user is not None:
+        return user
+    generation = principal_cache.generation
     user = await _get_user_by_login_for_auth(login=username, db=db)
     if user is None:
         raise credentials_exception
+    # an update or delete committed during the lookup may have evicted what was just read
+    if principal_cache.generation == generation:
+        ttl = payload["exp"] - time.time() if "exp" in payload else None
+        principal_cache.backend.set(username, user, ttl=ttl, tag=user.user_id)
     return user
 
 
@@ -1,60 +1,234 @@
-from uuid import UUID
+import csv
+import io
+import json
+from datetime import date
+from typing import AsyncIterator
+from uuid import UUID, uuid4
 
-from api.schemas import SalaryInfoCreate, ShowSalaryInfo
+import settings
+from api.actions.user import check_user_permissions
+from api.parsers import parse_record
+from api.schemas import SalaryInfoCreate, ShowSalaryInfo, BulkSalaryInfoError, BulkSalaryInfoResponse, \
+    ExportFormat, SalaryStats, SalaryStatsMode, SalaryInfoPage, BatchSalaryInfoResult, BatchSalaryInfosResponse, \
+    BatchGetError
+from api.validation import validate_salary_info_create
 from db.dals import UserDAL
+from db.entity_cache import read_through, salary_info_cache, SalaryInfoSnapshot
+from db.models import User
+from db.session import transaction
+from single_flight import coalesce
 
 
 async def _create_new_salary_info(body: SalaryInfoCreate, db) -> ShowSalaryInfo:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            salary_info = await user_dal.create_salary_info(
-                user_id=body.user_id,
-                salary=body.salary,
-                next_salary_increase=body.next_salary_increase
-            )
-            return ShowSalaryInfo(
-                salary_id=salary_info.salary_id,
-                user_id=salary_info.user_id,
-                salary=salary_info.salary,
-                next_salary_increase=salary_info.next_salary_increase
-            )
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        salary_info = await user_dal.create_salary_info(
+            user_id=body.user_id,
+            salary=body.salary,
+            next_salary_increase=body.next_salary_increase
+        )
+        return ShowSalaryInfo(
+            salary_id=salary_info.salary_id,
+            user_id=salary_info.user_id,
+            salary=salary_info.salary,
+            next_salary_increase=salary_info.next_salary_increase
+        )
 
 
-async def _get_salary_info_by_user_id(user_id, db) -> ShowSalaryInfo | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            salary_info = await user_dal.get_salary_info_by_user_id(user_id=user_id)
-            if salary_info is not None:
-                return salary_info
+# a miss is cached too, creating the salary info invalidates it
+@read_through(salary_info_cache, "salary_info_by_user_id", tag_of=lambda user_id, salary_info: user_id)
+@coalesce("salary_info_by_user_id")
+async def _get_salary_info_by_user_id(user_id, db) -> SalaryInfoSnapshot | None:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        salary_info = await user_dal.get_salary_info_by_user_id(user_id=user_id)
+        if salary_info is not None:
+            return SalaryInfoSnapshot.from_model(salary_info)
 
 
-async def _get_salary_info_by_salary_id(salary_id, db) -> ShowSalaryInfo | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            salary_info = await user_dal.get_salary_info_by_salary_id(salary_id=salary_id)
-            if salary_info is not None:
-                return salary_info
+@coalesce("salary_info_fields_by_user_id")
+async def _get_salary_info_fields_by_user_id(user_id, db) -> dict | None:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        return await user_dal.get_salary_info_fields_by_user_id(user_id=user_id)
 
 
-async def _update_salary_info(updated_user_params: dict, salary_id: UUID, db) -> UUID | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            updated_salary_id = await user_dal.update_salary_info(
-                salary_id=salary_id,
-                **updated_user_params
-            )
-            return updated_salary_id
+async def _get_salary_infos_by_user_ids(user_ids: list[UUID], cur_user: User, db) -> BatchSalaryInfosResponse:
+    """One result per requested user_id, in request order, permissions checked in memory."""
+    async with transaction(db) as session:
+        rows = await UserDAL(session).get_salary_infos_with_users_by_user_ids(user_ids=list(set(user_ids)))
+    found = {salary_info.user_id: (salary_info, user) for salary_info, user in rows}
+    results = []
+    for user_id in user_ids:
+        salary_info, user = found.get(user_id, (None, None))
+        if salary_info is None:
+            results.append(BatchSalaryInfoResult(user_id=user_id, error=BatchGetError.NOT_FOUND))
+        elif not check_user_permissions(target_user=user, cur_user=cur_user):
+            results.append(BatchSalaryInfoResult(user_id=user_id, error=BatchGetError.FORBIDDEN))
+        else:
+            results.append(BatchSalaryInfoResult(user_id=user_id, salary_info=ShowSalaryInfo.from_orm(salary_info)))
+    return BatchSalaryInfosResponse(results=results)
+
+
+async def _update_salary_info_if_permitted(
+        updated_user_params: dict, salary_id: UUID, cur_user: User, db
+) -> tuple[UUID | None, UUID | None]:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        return await user_dal.update_salary_info_if_permitted(
+            salary_id=salary_id,
+            cur_user=cur_user,
+            **updated_user_params
+        )
+
+
+async def _delete_salary_info_if_permitted(
+        salary_id: UUID, cur_user: User, db
+) -> tuple[UUID | None, UUID | None]:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        return await user_dal.delete_salary_info_if_permitted(
+            salary_id=salary_id,
+            cur_user=cur_user,
+        )
+
+
+async def _list_salary_increases_due(
+        cur_user: User,
+        date_from: date,
+        date_to: date,
+        limit: int,
+        cursor: tuple[date, UUID] | None,
+        db,
+) -> SalaryInfoPage:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        # one extra row tells whether there is a next page
+        salary_infos = await user_dal.list_salary_increases_due(
+            cur_user=cur_user, date_from=date_from, date_to=date_to, limit=limit + 1, after=cursor
+        )
+    next_cursor = None
+    if len(salary_infos) > limit:
+        last = salary_infos[limit - 1]
+        next_cursor = f"{last.next_salary_increase.isoformat()}_{last.salary_id}"
+    return SalaryInfoPage(
+        salary_infos=[ShowSalaryInfo.from_orm(salary_info) for salary_info in salary_infos[:limit]],
+        next_cursor=next_cursor,
+    )
+
+
+async def _upsert_salary_infos_chunk(
+        chunk: list[tuple[int, SalaryInfoCreate]], cur_user: User, db
+) -> tuple[int, list[BulkSalaryInfoError]]:
+    errors = []
+    rows = []
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        users = {
+            user.user_id: user
+            for user in await user_dal.get_users_by_ids([body.user_id for _, body in chunk])
+        }
+        for index, body in chunk:
+            user = users.get(body.user_id)
+            if user is None:
+                errors.append(BulkSalaryInfoError(index=index, user_id=body.user_id, error="User not found"))
+            elif not check_user_permissions(target_user=user, cur_user=cur_user):
+                errors.append(BulkSalaryInfoError(index=index, user_id=body.user_id, error="Forbidden"))
+            elif user.is_active is False:
+                errors.append(BulkSalaryInfoError(index=index, user_id=body.user_id, error="User is deactivated"))
+            else:
+                rows.append(dict(
+                    salary_id=uuid4(),
+                    user_id=body.user_id,
+                    salary=body.salary,
+                    next_salary_increase=body.next_salary_increase,
+                ))
+        upserted = await user_dal.upsert_salary_infos(rows)
+    return len(upserted), errors
+
+
+async def _upsert_salary_infos_bulk(
+        records: AsyncIterator[tuple[int, dict | ValueError]], cur_user: User, db
+) -> BulkSalaryInfoResponse:
+    """Validate and apply salary rows chunk by chunk, only errors are kept in memory."""
+    processed = 0
+    upserted = 0
+    errors = []
+    chunk = []
+    seen_user_ids = set()
+    async for index, record in records:
+        if index >= settings.BULK_MAX_ROWS:
+            # stop reading the body, one error stands for every record left
+            errors.append(BulkSalaryInfoError(
+                index=index,
+                error=f"Bulk limit of {settings.BULK_MAX_ROWS} records exceeded, records from here on were not read",
+            ))
+            break
+        processed += 1
+        body, error = parse_record(SalaryInfoCreate, validate_salary_info_create, record)
+        if error is not None:
+            errors.append(BulkSalaryInfoError(index=index, error=error))
+            continue
+        if body.user_id in seen_user_ids:
+            # ON CONFLICT DO UPDATE can't touch the same row twice in one statement
+            errors.append(BulkSalaryInfoError(index=index, user_id=body.user_id, error="Duplicate user_id in request"))
+            continue
+        seen_user_ids.add(body.user_id)
+        chunk.append((index, body))
+        if len(chunk) >= settings.BULK_CHUNK_SIZE:
+            chunk_upserted, chunk_errors = await _upsert_salary_infos_chunk(chunk, cur_user, db)
+            upserted += chunk_upserted
+            errors.extend(chunk_errors)
+            chunk = []
+    if chunk:
+        chunk_upserted, chunk_errors = await _upsert_salary_infos_chunk(chunk, cur_user, db)
+        upserted += chunk_upserted
+        errors.extend(chunk_errors)
+    errors.sort(key=lambda error: error.index)
+    return BulkSalaryInfoResponse(processed=processed, upserted=upserted, failed=len(errors), errors=errors)
+
+
+async def _iter_salary_export(cur_user: User, export_format: ExportFormat, db) -> AsyncIterator[str]:
+    """Encode salary rows batch by batch straight from the cursor, memory stays constant."""
+    async with transaction(db) as session:
+        result = await UserDAL(session).stream_salary_export(
+            cur_user=cur_user, batch_size=settings.EXPORT_BATCH_SIZE
+        )
+        columns = list(result.keys())
+        if export_format == ExportFormat.CSV:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            async for rows in result.partitions():
+                yield _encode_csv_rows(rows, writer, buffer)
+            if buffer.tell():
+                yield buffer.getvalue()
+        else:
+            async for rows in result.partitions():
+                yield _encode_ndjson_rows(columns, rows)
+
+
+def _encode_csv_rows(rows, writer, buffer: io.StringIO) -> str:
+    writer.writerows(rows)
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
+
+
+def _encode_ndjson_rows(columns: list[str], rows) -> str:
+    return "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows)
 
 
-async def _delete_salary_info(salary_id, db) -> UUID | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            deleted_salary_info_id = await user_dal.delete_salary_info(
-                salary_id=salary_id,
+async def _get_salary_stats(db) -> SalaryStats:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        if settings.SALARY_STATS_MODE != "rollup":
+            stats = await user_dal.compute_salary_stats(
+                buckets=settings.SALARY_STATS_HISTOGRAM_BUCKETS, months_ahead=settings.SALARY_STATS_MONTHS_AHEAD
             )
-            return deleted_salary_info_id
+            return SalaryStats(mode=SalaryStatsMode.LIVE, **stats)
+        stats = await user_dal.get_salary_stats_rollup(
+            bucket_width=settings.SALARY_STATS_BUCKET_WIDTH, months_ahead=settings.SALARY_STATS_MONTHS_AHEAD
+        )
+        return SalaryStats(mode=SalaryStatsMode.ROLLUP, **stats)
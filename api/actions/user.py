@@ -1,63 +1,192 @@
-from uuid import UUID
+import asyncio
+from typing import AsyncIterator
+from uuid import UUID, uuid4
 
 from fastapi import HTTPException
 
-from api.schemas import UserCreate, ShowUser
+import settings
+from api.parsers import parse_record
+from api.schemas import UserCreate, ShowUser, BulkUserResult, BulkCreateUsersResponse, UserPage, BatchUserResult, \
+    BatchUsersResponse, BatchGetError
+from api.validation import validate_user_create
 from db.dals import UserDAL, PortalRole
+from db.entity_cache import read_through, user_cache, UserSnapshot
 from db.models import User
+from db.session import transaction
 from hashing import Hasher
+from single_flight import coalesce
 
 
 async def _create_new_user(body: UserCreate, db) -> ShowUser:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            user = await user_dal.create_user(
+    hashed_password = await Hasher.get_password_hash_async(body.password)
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        user = await user_dal.create_user(
+            login=body.login,
+            name=body.name,
+            surname=body.surname,
+            email=body.email,
+            hashed_password=hashed_password,
+            roles=[PortalRole.ROLE_PORTAL_USER, ]
+        )
+        return ShowUser(
+            login=body.login,
+            user_id=user.user_id,
+            name=user.name,
+            surname=user.surname,
+            email=user.email,
+            is_active=user.is_active,
+        )
+
+
+async def _create_users_chunk(chunk: list[tuple[int, UserCreate]], db) -> list[BulkUserResult]:
+    results = []
+    async with transaction(db) as session:
+        taken_logins, taken_emails = await UserDAL(session).get_taken_logins_and_emails(
+            logins=[body.login for _, body in chunk],
+            emails=[body.email for _, body in chunk],
+        )
+    new_users = []
+    for index, body in chunk:
+        if body.login in taken_logins:
+            results.append(BulkUserResult(index=index, login=body.login, error="User with this login already exists"))
+        elif body.email in taken_emails:
+            results.append(BulkUserResult(index=index, login=body.login, error="User with this email already exists"))
+        else:
+            new_users.append((index, body))
+    # hash only the rows that can still be inserted
+    hashed_passwords = await asyncio.gather(
+        *(Hasher.get_password_hash_async(body.password) for _, body in new_users)
+    )
+    async with transaction(db) as session:
+        created = await UserDAL(session).create_users_bulk([
+            dict(
+                user_id=uuid4(),
                 login=body.login,
                 name=body.name,
                 surname=body.surname,
                 email=body.email,
-                hashed_password=Hasher.get_password_hash(body.password),
-                roles=[PortalRole.ROLE_PORTAL_USER, ]
-            )
-            return ShowUser(
-                login=body.login,
-                user_id=user.user_id,
-                name=user.name,
-                surname=user.surname,
-                email=user.email,
-                is_active=user.is_active,
+                is_active=True,
+                hashed_password=hashed_password,
+                roles=[PortalRole.ROLE_PORTAL_USER, ],
             )
+            for (_, body), hashed_password in zip(new_users, hashed_passwords)
+        ])
+    for index, body in new_users:
+        if body.login in created:
+            results.append(BulkUserResult(index=index, login=body.login, user_id=created[body.login]))
+        else:
+            # lost a race with a concurrent insert
+            results.append(BulkUserResult(
+                index=index, login=body.login, error="User with this login or email already exists"
+            ))
+    return results
+
+
+async def _create_new_users_bulk(records: AsyncIterator[tuple[int, dict | ValueError]], db) -> BulkCreateUsersResponse:
+    results = []
+    chunk = []
+    seen_logins, seen_emails = set(), set()
+    async for index, record in records:
+        if index >= settings.BULK_MAX_ROWS:
+            # stop reading the body, one error stands for every record left
+            results.append(BulkUserResult(
+                index=index,
+                error=f"Bulk limit of {settings.BULK_MAX_ROWS} records exceeded, records from here on were not read",
+            ))
+            break
+        body, error = parse_record(UserCreate, validate_user_create, record)
+        if error is not None:
+            results.append(BulkUserResult(index=index, error=error))
+            continue
+        if body.login in seen_logins or body.email in seen_emails:
+            results.append(BulkUserResult(index=index, login=body.login, error="Duplicate login or email in request"))
+            continue
+        seen_logins.add(body.login)
+        seen_emails.add(body.email)
+        chunk.append((index, body))
+        if len(chunk) >= settings.BULK_CHUNK_SIZE:
+            results.extend(await _create_users_chunk(chunk, db))
+            chunk = []
+    if chunk:
+        results.extend(await _create_users_chunk(chunk, db))
+    results.sort(key=lambda result: result.index)
+    failed = sum(result.error is not None for result in results)
+    return BulkCreateUsersResponse(created=len(results) - failed, failed=failed, results=results)
 
 
 async def _update_user(updated_user_params: dict, user_id: UUID, db) -> UUID | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            updated_user_id = await user_dal.update_user(
-                user_id=user_id,
-                **updated_user_params
-            )
-            return updated_user_id
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        updated_user_id = await user_dal.update_user(
+            user_id=user_id,
+            **updated_user_params
+        )
+        return updated_user_id
 
 
 async def _delete_user(user_id, db) -> UUID | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            deleted_user_id = await user_dal.delete_user(
-                user_id=user_id,
-            )
-            return deleted_user_id
-
-
-async def _get_user_by_id(user_id, db) -> User | None:
-    async with db as session:
-        async with session.begin():
-            user_dal = UserDAL(session)
-            user = await user_dal.get_user_by_id(user_id=user_id)
-            if user is not None:
-                return user
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        deleted_user_id = await user_dal.delete_user(
+            user_id=user_id,
+        )
+        return deleted_user_id
+
+
+@read_through(user_cache, "user_by_id", tag_of=lambda user_id, user: user_id if user is not None else None)
+@coalesce("user_by_id")
+async def _get_user_by_id(user_id, db) -> UserSnapshot | None:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        user = await user_dal.get_user_by_id(user_id=user_id)
+        if user is not None:
+            return UserSnapshot.from_model(user)
+
+
+@coalesce("user_fields_by_id")
+async def _get_user_fields_by_id(user_id, db) -> dict | None:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        return await user_dal.get_user_fields_by_id(user_id=user_id)
+
+
+async def _get_users_by_ids(user_ids: list[UUID], cur_user: User, db) -> BatchUsersResponse:
+    """One result per requested id, in request order, permissions checked in memory."""
+    async with transaction(db) as session:
+        users = {user.user_id: user for user in await UserDAL(session).get_users_by_ids(user_ids=list(set(user_ids)))}
+    results = []
+    for user_id in user_ids:
+        user = users.get(user_id)
+        if user is None:
+            results.append(BatchUserResult(user_id=user_id, error=BatchGetError.NOT_FOUND))
+        elif not check_user_permissions(target_user=user, cur_user=cur_user):
+            results.append(BatchUserResult(user_id=user_id, error=BatchGetError.FORBIDDEN))
+        else:
+            results.append(BatchUserResult(user_id=user_id, user=ShowUser.from_orm(user)))
+    return BatchUsersResponse(results=results)
+
+
+async def _list_users(
+        limit: int,
+        cursor: UUID | None,
+        is_active: bool | None,
+        role: PortalRole | None,
+        name_prefix: str | None,
+        db,
+) -> UserPage:
+    async with transaction(db) as session:
+        user_dal = UserDAL(session)
+        # one extra row tells whether there is a next page
+        users = await user_dal.list_users(
+            limit=limit + 1,
+            after_user_id=cursor,
+            is_active=is_active,
+            role=role,
+            name_prefix=name_prefix,
+        )
+    next_cursor = users[limit - 1].user_id if len(users) > limit else None
+    return UserPage(users=[ShowUser.from_orm(user) for user in users[:limit]], next_cursor=next_cursor)
 
 
 def check_user_permissions(target_user: User, cur_user: User) -> bool:
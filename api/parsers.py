@@ -0,0 +1,102 @@
+import csv
+import json
+from typing import AsyncIterator, Callable, Type
+
+from fastapi import HTTPException, Request
+from pydantic import BaseModel
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into text lines without reading it all into memory."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode().rstrip("\r")
+    if buffer:
+        yield buffer.decode().rstrip("\r")
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | ValueError]]:
+    """Yield ``(index, record)`` per non-empty line, a ValueError for lines that aren't a JSON object."""
+    index = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("Record should be a JSON object")
+        except ValueError as err:
+            record = ValueError(str(err))
+        yield index, record
+        index += 1
+
+
+async def iter_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | ValueError]]:
+    """Yield ``(index, record)`` per CSV data row, keyed by the header row.
+
+    Rows are parsed one line at a time, quoted fields can't span lines.
+    """
+    header = None
+    index = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        row = next(csv.reader([line]))
+        if header is None:
+            header = [name.strip() for name in row]
+            continue
+        if len(row) != len(header):
+            record = ValueError(f"Expected {len(header)} columns, got {len(row)}")
+        else:
+            record = dict(zip(header, row))
+        yield index, record
+        index += 1
+
+
+async def iter_records(request: Request) -> AsyncIterator[tuple[int, dict | ValueError]]:
+    """Records of a bulk request body: an NDJSON or CSV stream, or a JSON array."""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(NDJSON_CONTENT_TYPES):
+        async for index, record in iter_ndjson(request.stream()):
+            yield index, record
+        return
+    if content_type.startswith(CSV_CONTENT_TYPES):
+        async for index, record in iter_csv(request.stream()):
+            yield index, record
+        return
+    try:
+        records = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Request body should be a JSON array, NDJSON or CSV")
+    if not isinstance(records, list):
+        raise HTTPException(status_code=422, detail="Request body should be a JSON array, NDJSON or CSV")
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            record = ValueError("Record should be a JSON object")
+        yield index, record
+
+
+def parse_record(
+        schema: Type[BaseModel],
+        validate: Callable[[dict], tuple[dict | None, dict[str, str]]],
+        record: dict | ValueError,
+) -> tuple[BaseModel | None, str | None]:
+    """Validate one bulk record in one pass, returning the model or every field error instead of raising.
+
+    ``validate`` is one of the ``api.validation`` validators, the model is built
+    from the values it returns without validating them again.
+    """
+    if isinstance(record, ValueError):
+        return None, str(record)
+    if not isinstance(record, dict):
+        return None, "Record should be an object"
+    values, errors = validate(record)
+    if errors:
+        return None, "; ".join(f"{field}: {error}" for field, error in errors.items())
+    return schema.construct(**values), None
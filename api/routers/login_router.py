@@ -1,28 +1,42 @@
-from datetime import timedelta
-
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-import settings
-from api.actions.auth import authenticate_user, get_current_user_from_token
+from api.actions.auth import authenticate_user, get_current_user_from_token, access_token_claims, \
+    authenticate_refresh_token, create_refresh_token, throttle_login
 from db.models import User
 from db.session import get_db
 
-from api.schemas import Token
+from api.schemas import Token, RefreshTokenRequest
 from security import create_access_token
 
 login_router = APIRouter()
 
 
-@login_router.post("/token", response_model=Token)
+@login_router.post("/token", response_model=Token, dependencies=[Depends(throttle_login)])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
-    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    claims, access_token_expires = access_token_claims(user)
+    access_token = create_access_token(
+        data=claims, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": create_refresh_token(user)}
+
+
+@login_router.post("/refresh", response_model=Token)
+async def refresh_access_token(body: RefreshTokenRequest, db: AsyncSession = Depends(get_db)):
+    """New access token for a valid refresh token, without the password check.
+
+    The refresh token stays valid until it expires or the user's token_version changes.
+    """
+    user = await authenticate_refresh_token(body.refresh_token, db)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    claims, access_token_expires = access_token_claims(user)
     access_token = create_access_token(
-        data={"sub": user.login}, expires_delta=access_token_expires
+        data=claims, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
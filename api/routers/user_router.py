@@ -1,18 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from logging import getLogger
 from uuid import UUID
+from datetime import date
 
+import settings
 from api.actions.auth import get_current_user_from_token
-from api.actions.salary_info import _create_new_salary_info, _get_salary_info_by_user_id, _update_salary_info, \
-    _get_salary_info_by_salary_id, _delete_salary_info
+from api.actions.salary_info import _create_new_salary_info, _get_salary_info_by_user_id, \
+    _update_salary_info_if_permitted, _delete_salary_info_if_permitted, _upsert_salary_infos_bulk, \
+    _iter_salary_export, _get_salary_stats, _list_salary_increases_due, \
+    _get_salary_info_fields_by_user_id, _get_salary_infos_by_user_ids
 from api.actions.user import _create_new_user, _get_user_by_id, check_user_permissions, _delete_user, \
-    _update_user
+    _update_user, _create_new_users_bulk, _list_users, _get_user_fields_by_id, _get_users_by_ids
+from api.parsers import iter_records
 from api.schemas import UserCreate, UpdateUser, ShowUser, DeleteUserResponse, UpdatedUserResponse, ShowSalaryInfo, \
-    SalaryInfoCreate, UpdatedSalaryInfoResponse, UpdateSalaryInfo, DeleteSalaryInfoResponse
+    SalaryInfoCreate, UpdatedSalaryInfoResponse, UpdateSalaryInfo, DeleteSalaryInfoResponse, BulkCreateUsersResponse, \
+    BulkSalaryInfoResponse, UserPage, ExportFormat, SalaryStats, SalaryInfoPage, BatchGetRequest, BatchUsersResponse, \
+    BatchSalaryInfosResponse
 from db.models import User, PortalRole
-from db.session import get_db
+from db.session import get_db, get_read_db, unit_of_work
 
 logger = getLogger(__name__)
 
@@ -31,46 +39,101 @@ async def create_user(body: UserCreate, db: AsyncSession = Depends(get_db)):
         )
 
 
-@user_router.delete("/", response_model=DeleteUserResponse)
-async def delete_user(
-        user_id: UUID, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+@user_router.post("/bulk", response_model=BulkCreateUsersResponse)
+async def create_users_bulk(
+        request: Request, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
 ):
-    user = await _get_user_by_id(user_id, db)
-    if user is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"User with id {user_id} not found."
-        )
-    if PortalRole.ROLE_PORTAL_SUPERUSER in cur_user.roles:
-        raise HTTPException(status_code=406, detail="Superuser can't be deleted using API")
-    if not check_user_permissions(target_user=user, cur_user=cur_user):
+    """Create users from a JSON array or an NDJSON stream of UserCreate records.
+
+    Every record gets its own result, a failed record doesn't stop the others.
+    """
+    if not (cur_user.is_admin or cur_user.is_superuser):
         raise HTTPException(
             status_code=403,
             detail="Forbidden."
         )
+    return await _create_new_users_bulk(iter_records(request), db)
 
-    deleted_user_id = await _delete_user(user_id, db)
-    if deleted_user_id is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"User with id {user_id} not found."
-        )
-    return DeleteUserResponse(deleted_user_id=deleted_user_id)
+
+@user_router.delete("/", response_model=DeleteUserResponse)
+async def delete_user(
+        user_id: UUID, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+):
+    async with unit_of_work(db):
+        user = await _get_user_by_id(user_id, db)
+        if user is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"User with id {user_id} not found."
+            )
+        if PortalRole.ROLE_PORTAL_SUPERUSER in cur_user.roles:
+            raise HTTPException(status_code=406, detail="Superuser can't be deleted using API")
+        if not check_user_permissions(target_user=user, cur_user=cur_user):
+            raise HTTPException(
+                status_code=403,
+                detail="Forbidden."
+            )
+
+        deleted_user_id = await _delete_user(user_id, db)
+        if deleted_user_id is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"User with id {user_id} not found."
+            )
+        return DeleteUserResponse(deleted_user_id=deleted_user_id)
 
 
 @user_router.get("/", response_model=ShowUser)
 async def get_user_by_id(
-        user_id: UUID, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+        user_id: UUID, db: AsyncSession = Depends(get_read_db), cur_user: User = Depends(get_current_user_from_token),
 ):
-    user = await _get_user_by_id(user_id, db)
+    if settings.FAST_READ_RESPONSES:
+        user = await _get_user_fields_by_id(user_id, db)
+    else:
+        user = await _get_user_by_id(user_id, db)
     if user is None:
         raise HTTPException(
             status_code=404,
             detail=f"User with id {user_id} not found."
         )
+    if settings.FAST_READ_RESPONSES:
+        return ORJSONResponse(user)
     return user
 
 
+@user_router.get("/list", response_model=UserPage)
+async def list_users(
+        cursor: UUID | None = None,
+        limit: int = Query(default=settings.USER_LIST_DEFAULT_LIMIT, ge=1, le=settings.USER_LIST_MAX_LIMIT),
+        is_active: bool | None = None,
+        role: PortalRole | None = None,
+        name_prefix: str | None = Query(default=None, min_length=1),
+        db: AsyncSession = Depends(get_read_db),
+        cur_user: User = Depends(get_current_user_from_token),
+):
+    """Users ordered by user_id. Pass ``next_cursor`` of a page as ``cursor`` to get the next one."""
+    if not (cur_user.is_admin or cur_user.is_superuser):
+        raise HTTPException(
+            status_code=403,
+            detail="Forbidden."
+        )
+    return await _list_users(
+        limit=limit, cursor=cursor, is_active=is_active, role=role, name_prefix=name_prefix, db=db
+    )
+
+
+@user_router.post("/batch", response_model=BatchUsersResponse)
+async def get_users_by_ids(
+        body: BatchGetRequest, db: AsyncSession = Depends(get_read_db),
+        cur_user: User = Depends(get_current_user_from_token),
+):
+    """Users of up to BATCH_GET_MAX_IDS ids in one query, in request order.
+
+    Ids that don't exist or that the current user may not see come back with an error instead.
+    """
+    return await _get_users_by_ids(body.user_ids, cur_user, db)
+
+
 @user_router.patch("/", response_model=UpdatedUserResponse)
 async def update_user_by_id(
         user_id: UUID,
@@ -84,31 +147,32 @@ async def update_user_by_id(
             detail=f"At least one parameter for user update info should be provided"
         )
 
-    user = await _get_user_by_id(user_id, db)
-    if user is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"User with id {user_id} not found."
-        )
-
-    if user_id != cur_user.user_id:
-        if not check_user_permissions(target_user=user, cur_user=cur_user):
+    async with unit_of_work(db):
+        user = await _get_user_by_id(user_id, db)
+        if user is None:
             raise HTTPException(
-                status_code=403,
-                detail="Forbidden."
+                status_code=404,
+                detail=f"User with id {user_id} not found."
             )
 
-    try:
-        updated_user_id = await _update_user(
-            updated_user_params=updated_user_params, db=db, user_id=user_id
-        )
-    except IntegrityError as err:
-        logger.error(err)
-        raise HTTPException(
-            status_code=503,
-            detail=f"Database error: {err}"
-        )
-    return UpdatedUserResponse(updated_user_id=updated_user_id)
+        if user_id != cur_user.user_id:
+            if not check_user_permissions(target_user=user, cur_user=cur_user):
+                raise HTTPException(
+                    status_code=403,
+                    detail="Forbidden."
+                )
+
+        try:
+            updated_user_id = await _update_user(
+                updated_user_params=updated_user_params, db=db, user_id=user_id
+            )
+        except IntegrityError as err:
+            logger.error(err)
+            raise HTTPException(
+                status_code=503,
+                detail=f"Database error: {err}"
+            )
+        return UpdatedUserResponse(updated_user_id=updated_user_id)
 
 
 @user_router.patch("/admin_privilege", response_model=UpdatedUserResponse)
@@ -128,32 +192,33 @@ async def give_admin_privilege(
             status_code=400,
             detail="Cannot manage privileges of itself."
         )
-    user_for_promotion = await _get_user_by_id(user_id, db)
-    if user_for_promotion.is_admin or user_for_promotion.is_superuser:
-        raise HTTPException(
-            status_code=409,
-            detail=f"User with id {user_id} already promoted to admin / superuser.",
-        )
-    if user_for_promotion is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"User with id {user_id} not found."
-        )
-    updated_user_params = {
-        "roles": user_for_promotion.add_admin_privileges_for_user()
-    }
+    async with unit_of_work(db):
+        user_for_promotion = await _get_user_by_id(user_id, db)
+        if user_for_promotion.is_admin or user_for_promotion.is_superuser:
+            raise HTTPException(
+                status_code=409,
+                detail=f"User with id {user_id} already promoted to admin / superuser.",
+            )
+        if user_for_promotion is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"User with id {user_id} not found."
+            )
+        updated_user_params = {
+            "roles": user_for_promotion.add_admin_privileges_for_user()
+        }
 
-    try:
-        updated_user_id = await _update_user(
-            updated_user_params=updated_user_params, db=db, user_id=user_id
-        )
-    except IntegrityError as err:
-        logger.error(err)
-        raise HTTPException(
-            status_code=503,
-            detail=f"Database error: {err}"
-        )
-    return UpdatedUserResponse(updated_user_id=updated_user_id)
+        try:
+            updated_user_id = await _update_user(
+                updated_user_params=updated_user_params, db=db, user_id=user_id
+            )
+        except IntegrityError as err:
+            logger.error(err)
+            raise HTTPException(
+                status_code=503,
+                detail=f"Database error: {err}"
+            )
+        return UpdatedUserResponse(updated_user_id=updated_user_id)
 
 
 @user_router.post("/salary", response_model=ShowSalaryInfo)
@@ -161,40 +226,145 @@ async def create_salary_info(
         body: SalaryInfoCreate, cur_user: User = Depends(get_current_user_from_token),
         db: AsyncSession = Depends(get_db)):
 
-    user = await _get_user_by_id(body.user_id, db)
-    if not check_user_permissions(target_user=user, cur_user=cur_user):
+    async with unit_of_work(db):
+        user = await _get_user_by_id(body.user_id, db)
+        if not check_user_permissions(target_user=user, cur_user=cur_user):
+            raise HTTPException(
+                status_code=403,
+                detail="Forbidden."
+            )
+        if user.is_active is False:
+            raise HTTPException(
+                status_code=403,
+                detail=f"User with id {body.user_id} is deactivated."
+            )
+        try:
+            return await _create_new_salary_info(body, db)
+        except IntegrityError as err:
+            logger.error(err)
+            raise HTTPException(
+                status_code=503,
+                detail=f"Database error: {err}"
+            )
+
+
+@user_router.post("/salary/bulk", response_model=BulkSalaryInfoResponse)
+async def upsert_salary_infos_bulk(
+        request: Request, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+):
+    """Create or replace salary info per user from a CSV, NDJSON or JSON array body.
+
+    CSV needs a header row: user_id,salary,next_salary_increase.
+    """
+    if not (cur_user.is_admin or cur_user.is_superuser):
         raise HTTPException(
             status_code=403,
             detail="Forbidden."
         )
-    if user.is_active is False:
+    return await _upsert_salary_infos_bulk(iter_records(request), cur_user, db)
+
+
+@user_router.get("/salary/export", response_class=StreamingResponse)
+async def export_salary_infos(
+        export_format: ExportFormat = Query(default=ExportFormat.CSV, alias="format"),
+        db: AsyncSession = Depends(get_db),
+        cur_user: User = Depends(get_current_user_from_token),
+):
+    """Stream every salary info the current admin/superuser may manage, joined to its user."""
+    if not (cur_user.is_admin or cur_user.is_superuser):
         raise HTTPException(
             status_code=403,
-            detail=f"User with id {body.user_id} is deactivated."
+            detail="Forbidden."
         )
-    try:
-        return await _create_new_salary_info(body, db)
-    except IntegrityError as err:
-        logger.error(err)
+    media_type = "text/csv" if export_format == ExportFormat.CSV else "application/x-ndjson"
+    return StreamingResponse(
+        _iter_salary_export(cur_user=cur_user, export_format=export_format, db=db),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=salary_info.{export_format.value}"},
+    )
+
+
+@user_router.get("/salary/stats", response_model=SalaryStats)
+async def get_salary_stats(
+        db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+):
+    """Org-wide salary count, mean, percentiles, histogram and upcoming increases per month."""
+    if not (cur_user.is_admin or cur_user.is_superuser):
         raise HTTPException(
-            status_code=503,
-            detail=f"Database error: {err}"
+            status_code=403,
+            detail="Forbidden."
         )
+    return await _get_salary_stats(db)
+
+
+@user_router.get("/salary/increases", response_model=SalaryInfoPage)
+async def list_salary_increases_due(
+        date_from: date,
+        date_to: date,
+        cursor: str | None = None,
+        limit: int = Query(default=settings.USER_LIST_DEFAULT_LIMIT, ge=1, le=settings.USER_LIST_MAX_LIMIT),
+        db: AsyncSession = Depends(get_read_db),
+        cur_user: User = Depends(get_current_user_from_token),
+):
+    """Salary infos with a raise due between ``date_from`` and ``date_to`` inclusive, soonest first.
+
+    Pass ``next_cursor`` of a page as ``cursor`` to get the next one.
+    """
+    if not (cur_user.is_admin or cur_user.is_superuser):
+        raise HTTPException(
+            status_code=403,
+            detail="Forbidden."
+        )
+    if date_from > date_to:
+        raise HTTPException(
+            status_code=422,
+            detail="date_from should not be later than date_to"
+        )
+    after = None
+    if cursor is not None:
+        try:
+            after_date, after_salary_id = cursor.split("_", 1)
+            after = (date.fromisoformat(after_date), UUID(after_salary_id))
+        except ValueError:
+            raise HTTPException(
+                status_code=422,
+                detail="Invalid cursor."
+            )
+    return await _list_salary_increases_due(
+        cur_user=cur_user, date_from=date_from, date_to=date_to, limit=limit, cursor=after, db=db
+    )
 
 
 @user_router.get("/salary", response_model=ShowSalaryInfo)
 async def get_salary_info_of_current_user(
-    db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
+    db: AsyncSession = Depends(get_read_db), cur_user: User = Depends(get_current_user_from_token),
 ):
-    salary_info = await _get_salary_info_by_user_id(cur_user.user_id, db)
+    if settings.FAST_READ_RESPONSES:
+        salary_info = await _get_salary_info_fields_by_user_id(cur_user.user_id, db)
+    else:
+        salary_info = await _get_salary_info_by_user_id(cur_user.user_id, db)
     if salary_info is None:
         raise HTTPException(
             status_code=404,
             detail=f"Your salary info not found ( user_id = {cur_user.user_id} ). "
         )
+    if settings.FAST_READ_RESPONSES:
+        return ORJSONResponse(salary_info)
     return salary_info
 
 
+@user_router.post("/salary/batch", response_model=BatchSalaryInfosResponse)
+async def get_salary_infos_by_user_ids(
+        body: BatchGetRequest, db: AsyncSession = Depends(get_read_db),
+        cur_user: User = Depends(get_current_user_from_token),
+):
+    """Salary infos of up to BATCH_GET_MAX_IDS users in one query, in request order.
+
+    Users without salary info or that the current user may not see come back with an error instead.
+    """
+    return await _get_salary_infos_by_user_ids(body.user_ids, cur_user, db)
+
+
 @user_router.patch("/salary", response_model=UpdatedSalaryInfoResponse)
 async def update_salary_info_by_salary_id(
         salary_id: UUID,
@@ -208,23 +378,9 @@ async def update_salary_info_by_salary_id(
             detail=f"At least one parameter for user update info should be provided"
         )
 
-    salary_info = await _get_salary_info_by_salary_id(salary_id, db)
-    if salary_info is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Salary info with id {salary_id} not found."
-        )
-
-    user = await _get_user_by_id(salary_info.user_id, db)
-    if not check_user_permissions(target_user=user, cur_user=cur_user):
-        raise HTTPException(
-            status_code=403,
-            detail="Forbidden."
-        )
-
     try:
-        updated_salary_id = await _update_salary_info(
-            updated_user_params=updated_user_params, db=db, salary_id=salary_id
+        found_salary_id, updated_salary_id = await _update_salary_info_if_permitted(
+            updated_user_params=updated_user_params, salary_id=salary_id, cur_user=cur_user, db=db
         )
     except IntegrityError as err:
         logger.error(err)
@@ -232,6 +388,16 @@ async def update_salary_info_by_salary_id(
             status_code=503,
             detail=f"Database error: {err}"
         )
+    if found_salary_id is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Salary info with id {salary_id} not found."
+        )
+    if updated_salary_id is None:
+        raise HTTPException(
+            status_code=403,
+            detail="Forbidden."
+        )
     return UpdatedSalaryInfoResponse(updated_salary_id=updated_salary_id)
 
 
@@ -239,23 +405,17 @@ async def update_salary_info_by_salary_id(
 async def delete_salary_info(
         salary_id: UUID, db: AsyncSession = Depends(get_db), cur_user: User = Depends(get_current_user_from_token),
 ):
-    salary_info = await _get_salary_info_by_salary_id(salary_id, db)
-    if salary_info is None:
+    found_salary_id, deleted_salary_id = await _delete_salary_info_if_permitted(
+        salary_id=salary_id, cur_user=cur_user, db=db
+    )
+    if found_salary_id is None:
         raise HTTPException(
             status_code=404,
             detail=f"Salary info with id {salary_id} not found."
         )
-    user = await _get_user_by_id(salary_info.user_id, db)
-    if not check_user_permissions(target_user=user, cur_user=cur_user):
+    if deleted_salary_id is None:
         raise HTTPException(
             status_code=403,
             detail="Forbidden."
         )
-
-    deleted_salary_id = await _delete_salary_info(salary_id, db)
-    if deleted_salary_id is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Salary with id {salary_id} not found."
-        )
     return DeleteSalaryInfoResponse(deleted_salary_id=deleted_salary_id)
@@ -1,13 +1,14 @@
 import uuid
-import re
+from decimal import Decimal
+from enum import Enum
 from typing import Optional
 
 from fastapi import HTTPException
-from pydantic import BaseModel, EmailStr, validator, constr
+from pydantic import BaseModel, EmailStr, validator, constr, conlist
 from datetime import date, datetime
 
-VALIDATE_USER_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z\-]+$")
-date_format = '%Y-%m-%d'
+import settings
+from api.validation import VALIDATE_USER_PATTERN, DATE_ERROR, NAME_ERROR, SURNAME_ERROR, Salary, parse_date
 
 
 class TunedModel(BaseModel):
@@ -26,55 +27,42 @@ class UserCreate(TunedModel):
     @validator("name")
     def validate_name(cls, value):
         if not VALIDATE_USER_PATTERN.match(value):
-            raise HTTPException(status_code=422, detail="Name should contains only letters")
+            raise HTTPException(status_code=422, detail=NAME_ERROR)
         return value
 
     @validator("surname")
     def validate_surname(cls, value):
         if not VALIDATE_USER_PATTERN.match(value):
-            raise HTTPException(status_code=422, detail="Surname should contains only letters")
+            raise HTTPException(status_code=422, detail=SURNAME_ERROR)
         return value
 
 
+def parse_next_salary_increase(value):
+    if value is None:
+        return value
+    parsed = parse_date(value)
+    if parsed is None:
+        raise HTTPException(status_code=422, detail=DATE_ERROR)
+    return parsed
+
+
 class SalaryInfoCreate(TunedModel):
     user_id: uuid.UUID
-    salary: float | int
-    next_salary_increase: str
-
-    @validator("salary")
-    def validate_salary(cls, value):
-        if type(value) is int:
-            salary = float(value)
-            return salary
-        return value
+    salary: Salary
+    next_salary_increase: date
 
-    @validator("next_salary_increase")
+    @validator("next_salary_increase", pre=True)
     def validate_next_salary_increase(cls, value):
-        try:
-            datetime.strptime(value, date_format)
-        except ValueError:
-            raise HTTPException(status_code=422, detail="Incorrect data format, should be YYYY-MM-DD")
-        return value
+        return parse_next_salary_increase(value)
 
 
 class UpdateSalaryInfo(BaseModel):
-    salary: float | None
-    next_salary_increase: Optional[constr(min_length=1)]
-
-    @validator("salary")
-    def validate_salary(cls, value):
-        if type(value) is int:
-            salary = float(value)
-            return salary
-        return value
+    salary: Salary | None
+    next_salary_increase: Optional[date]
 
-    @validator("next_salary_increase")
+    @validator("next_salary_increase", pre=True)
     def validate_next_salary_increase(cls, value):
-        try:
-            datetime.strptime(value, date_format)
-        except ValueError:
-            raise HTTPException(status_code=422, detail="Incorrect data format, should be YYYY-MM-DD")
-        return value
+        return parse_next_salary_increase(value)
 
 
 class UpdateUser(BaseModel):
@@ -85,13 +73,13 @@ class UpdateUser(BaseModel):
     @validator("name")
     def validate_name(cls, value):
         if not VALIDATE_USER_PATTERN.match(value):
-            raise HTTPException(status_code=422, detail="Name should contains only letters")
+            raise HTTPException(status_code=422, detail=NAME_ERROR)
         return value
 
     @validator("surname")
     def validate_surname(cls, value):
         if not VALIDATE_USER_PATTERN.match(value):
-            raise HTTPException(status_code=422, detail="Surname should contains only letters")
+            raise HTTPException(status_code=422, detail=SURNAME_ERROR)
         return value
 
 
@@ -112,16 +100,26 @@ class ShowUser(TunedModel):
     is_active: bool
 
 
+class UserPage(BaseModel):
+    users: list[ShowUser]
+    next_cursor: uuid.UUID | None
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 
 class ShowSalaryInfo(TunedModel):
     salary_id: uuid.UUID
     user_id: uuid.UUID
-    salary: float
-    next_salary_increase: str
+    salary: Decimal
+    next_salary_increase: date
 
 
 class UpdatedSalaryInfoResponse(BaseModel):
@@ -129,3 +127,100 @@ class UpdatedSalaryInfoResponse(BaseModel):
 
 class DeleteSalaryInfoResponse(BaseModel):
     deleted_salary_id: uuid.UUID
+
+
+class BulkUserResult(BaseModel):
+    index: int
+    login: str | None
+    user_id: uuid.UUID | None
+    error: str | None
+
+
+class BulkCreateUsersResponse(BaseModel):
+    created: int
+    failed: int
+    results: list[BulkUserResult]
+
+
+class BulkSalaryInfoError(BaseModel):
+    index: int
+    user_id: uuid.UUID | None
+    error: str
+
+
+class BulkSalaryInfoResponse(BaseModel):
+    processed: int
+    upserted: int
+    failed: int
+    errors: list[BulkSalaryInfoError]
+
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+class SalaryStatsMode(str, Enum):
+    LIVE = "live"
+    ROLLUP = "rollup"
+
+
+class SalaryHistogramBucket(BaseModel):
+    lower: float
+    upper: float
+    count: int
+
+
+class UpcomingSalaryIncreases(BaseModel):
+    month: str
+    count: int
+
+
+class SalaryStats(BaseModel):
+    # the histograms differ: live has SALARY_STATS_HISTOGRAM_BUCKETS equal-width bins over
+    # [min, max], rollup the non-empty bins of SALARY_STATS_BUCKET_WIDTH
+    mode: SalaryStatsMode
+    count: int
+    mean: float | None
+    min: float | None
+    max: float | None
+    percentiles: dict[str, float]
+    histogram: list[SalaryHistogramBucket]
+    upcoming_increases: list[UpcomingSalaryIncreases]
+    computed_at: datetime
+    # rollup mode only, None until the first background refresh
+    percentiles_refreshed_at: datetime | None = None
+
+
+class SalaryInfoPage(BaseModel):
+    salary_infos: list[ShowSalaryInfo]
+    next_cursor: str | None
+
+
+class BatchGetRequest(BaseModel):
+    user_ids: conlist(uuid.UUID, min_items=1, max_items=settings.BATCH_GET_MAX_IDS)
+
+
+class BatchGetError(str, Enum):
+    NOT_FOUND = "not_found"
+    FORBIDDEN = "forbidden"
+
+
+class BatchUserResult(BaseModel):
+    user_id: uuid.UUID
+    user: ShowUser | None
+    error: BatchGetError | None
+
+
+class BatchUsersResponse(BaseModel):
+    results: list[BatchUserResult]
+
+
+class BatchSalaryInfoResult(BaseModel):
+    user_id: uuid.UUID
+    salary_info: ShowSalaryInfo | None
+    error: BatchGetError | None
+
+
+class BatchSalaryInfosResponse(BaseModel):
+    results: list[BatchSalaryInfoResult]
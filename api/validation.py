@@ -0,0 +1,128 @@
+"""One-pass payload validation for bulk create/upsert traffic.
+
+The schema validators raise ``HTTPException`` at the first bad field. These
+check every field of a record and return all errors at once, and invalid input
+is mostly rejected by compiled patterns instead of exceptions. The patterns, the
+date parsing and the ``Salary`` type are the ones ``api/schemas.py`` uses, so
+both paths accept the same values.
+"""
+import re
+from calendar import monthrange
+from datetime import date
+from decimal import Decimal
+from typing import Any, Callable
+from uuid import UUID
+
+from pydantic import condecimal
+from pydantic.errors import PydanticTypeError, PydanticValueError
+from pydantic.networks import validate_email
+from pydantic.validators import decimal_validator
+
+VALIDATE_USER_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z\-]+$")
+DATE_PATTERN = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+# cheap pre-check, whatever passes it still goes through pydantic's validate_email
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+UUID_PATTERN = re.compile(r"^(urn:uuid:)?\{?[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}\}?$")
+# matches salary_info.salary NUMERIC(14, 2), amounts are exact to the cent
+Salary = condecimal(max_digits=14, decimal_places=2)
+
+DATE_ERROR = "Incorrect data format, should be YYYY-MM-DD"
+NAME_ERROR = "Name should contains only letters"
+SURNAME_ERROR = "Surname should contains only letters"
+
+Check = Callable[[Any], tuple[Any, str | None]]
+
+
+def parse_date(value: Any) -> date | None:
+    """``YYYY-MM-DD`` (as ``strptime('%Y-%m-%d')`` accepts it) to a date, None when invalid."""
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        return None
+    match = DATE_PATTERN.match(value)
+    if match is None:
+        return None
+    year, month, day = int(match[1]), int(match[2]), int(match[3])
+    if year < 1 or not 1 <= month <= 12 or not 1 <= day <= monthrange(year, month)[1]:
+        return None
+    return date(year, month, day)
+
+
+def check_str(value: Any) -> tuple[Any, str | None]:
+    if isinstance(value, str):
+        return value, None
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return str(value), None
+    return None, "str type expected"
+
+
+def _check_pattern(pattern: re.Pattern, error: str) -> Check:
+    def check(value: Any) -> tuple[Any, str | None]:
+        if isinstance(value, str) and pattern.match(value):
+            return value, None
+        return None, error
+    return check
+
+
+check_name = _check_pattern(VALIDATE_USER_PATTERN, NAME_ERROR)
+check_surname = _check_pattern(VALIDATE_USER_PATTERN, SURNAME_ERROR)
+
+
+def check_email(value: Any) -> tuple[Any, str | None]:
+    if not isinstance(value, str) or not EMAIL_PATTERN.match(value):
+        return None, "value is not a valid email address"
+    try:
+        return validate_email(value)[1], None
+    except PydanticValueError as err:
+        return None, str(err)
+
+
+def check_uuid(value: Any) -> tuple[Any, str | None]:
+    if isinstance(value, UUID):
+        return value, None
+    if isinstance(value, str) and UUID_PATTERN.match(value):
+        return UUID(value), None
+    return None, "value is not a valid uuid"
+
+
+def check_salary(value: Any) -> tuple[Any, str | None]:
+    # Salary's own validators, a pattern would drift from what the schemas accept ("1e3", "1.000")
+    try:
+        return Salary.validate(decimal_validator(value)), None
+    except (PydanticTypeError, PydanticValueError) as err:
+        return None, str(err)
+
+
+def check_date(value: Any) -> tuple[Any, str | None]:
+    parsed = parse_date(value)
+    if parsed is None:
+        return None, DATE_ERROR
+    return parsed, None
+
+
+def _validator(checks: dict[str, Check], required: bool) -> Callable[[dict], tuple[dict | None, dict[str, str]]]:
+    def validate(record: dict) -> tuple[dict | None, dict[str, str]]:
+        values, errors = {}, {}
+        for field, check in checks.items():
+            value = record.get(field)
+            if value is None:
+                if required:
+                    errors[field] = "field required"
+                continue
+            value, error = check(value)
+            if error is None:
+                values[field] = value
+            else:
+                errors[field] = error
+        return (None if errors else values), errors
+    return validate
+
+
+# each returns (values, {}) or (None, {field: error}) for every invalid field
+validate_user_create = _validator(
+    {"login": check_str, "name": check_name, "surname": check_surname, "email": check_email, "password": check_str},
+    required=True,
+)
+validate_salary_info_create = _validator(
+    {"user_id": check_uuid, "salary": check_salary, "next_salary_increase": check_date}, required=True,
+)
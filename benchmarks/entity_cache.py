@@ -0,0 +1,102 @@
+"""Read helper throughput with and without the entity cache.
+
+Runs against TEST_DATABASE_URL, start it with ``make up`` and apply the
+migrations first:
+
+    python -m benchmarks.entity_cache
+
+Seeds USERS users with salary info, then runs LOOKUPS calls of
+``_get_user_by_id`` and ``_get_salary_info_by_user_id`` with a fresh session
+each, like separate requests. Keys are drawn from a skewed distribution (a few
+hot users, a long tail) and a write every WRITE_EVERY lookups invalidates one
+user's entries. Results are lookups per second and the cache hit rate.
+"""
+import asyncio
+import json
+import random
+import time
+from datetime import date
+from decimal import Decimal
+from uuid import uuid4
+
+import asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from api.actions.salary_info import _get_salary_info_by_user_id
+from api.actions.user import _get_user_by_id
+from db.dals import UserDAL
+from db.entity_cache import user_cache, salary_info_cache
+from db.models import PortalRole
+
+USERS = 1000
+LOOKUPS = 20000
+WRITE_EVERY = 100
+
+
+async def _seed(pool) -> list:
+    user_ids = [uuid4() for _ in range(USERS)]
+    async with pool.acquire() as connection:
+        await connection.execute("TRUNCATE TABLE users CASCADE;")
+        await connection.copy_records_to_table(
+            "users",
+            columns=["user_id", "name", "surname", "email", "is_active", "hashed_password", "login", "roles"],
+            records=[
+                (user_id, "bench", "bench", f"bench{i}@example.com", True, "hashed_pass", f"bench{i}",
+                 [PortalRole.ROLE_PORTAL_USER.value])
+                for i, user_id in enumerate(user_ids)
+            ],
+        )
+        await connection.copy_records_to_table(
+            "salary_info",
+            columns=["salary_id", "salary", "next_salary_increase", "user_id"],
+            records=[(uuid4(), Decimal(1000), date(2030, 1, 1), user_id) for user_id in user_ids],
+        )
+    return user_ids
+
+
+async def _run(session_factory, user_ids: list, enabled: bool) -> dict:
+    settings.ENTITY_CACHE_ENABLED = enabled
+    user_cache.clear()
+    salary_info_cache.clear()
+    rng = random.Random(0)
+    weights = [1 / (rank + 1) for rank in range(len(user_ids))]
+    keys = rng.choices(user_ids, weights, k=LOOKUPS)
+    hits_before = user_cache.backend.hits + salary_info_cache.backend.hits
+    lookups = 0
+    started = time.perf_counter()
+    for i, user_id in enumerate(keys):
+        async with session_factory() as session:
+            if i % WRITE_EVERY == WRITE_EVERY - 1:
+                async with session.begin():
+                    await UserDAL(session).update_user(user_id=user_id, surname="bench")
+                continue
+            await _get_user_by_id(user_id, session)
+            await _get_salary_info_by_user_id(user_id, session)
+            lookups += 2
+    elapsed = time.perf_counter() - started
+    hits = user_cache.backend.hits + salary_info_cache.backend.hits - hits_before
+    return {
+        "lookups_per_second": round(lookups / elapsed),
+        "hit_rate": round(hits / lookups, 3) if enabled else 0.0,
+    }
+
+
+async def measure() -> dict:
+    pool = await asyncpg.create_pool("".join(settings.TEST_DATABASE_URL.split("+asyncpg")))
+    engine = create_async_engine(settings.TEST_DATABASE_URL, future=True)
+    session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    try:
+        user_ids = await _seed(pool)
+        return {
+            "uncached": await _run(session_factory, user_ids, enabled=False),
+            "cached": await _run(session_factory, user_ids, enabled=True),
+        }
+    finally:
+        await pool.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(measure()), indent=2))
@@ -0,0 +1,235 @@
+"""Throughput and latency of a mixed workload against the whole API.
+
+Seeds ``--users`` users with salary info into TEST_DATABASE_URL (start it with
+``make up`` and apply the migrations first), then ``--concurrency`` clients send
+``--requests`` requests in total, picking endpoints by the weights in WORKLOAD:
+
+    python -m benchmarks.load_test --users 1000 --concurrency 32 --requests 20000
+
+By default ``main.app`` runs in-process over ASGI. Pass ``--base-url`` to load a
+running server instead (it must use the same database and run with
+LOGIN_RATE_LIMIT_ENABLED=false, all clients share one IP). Latency percentiles and
+requests per second are reported per endpoint and saved as JSON under
+``benchmarks/results/`` so runs can be compared over time.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import uuid4
+
+import asyncpg
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from db.models import PortalRole
+import db.session
+from db.session import get_db
+from hashing import Hasher
+from main import app
+from security import create_access_token
+
+PASSWORD = "bench_password"
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# endpoint -> relative weight in the mix
+WORKLOAD = {
+    "POST /login/token": 1,
+    "GET /user/": 4,
+    "GET /user/salary": 4,
+    "PATCH /user/salary": 1,
+}
+
+
+async def _seed(pool, users: int) -> list[dict]:
+    # one bcrypt hash for everybody, hashing every user would dominate the setup
+    hashed_password = Hasher.get_password_hash(PASSWORD)
+    seeded = [
+        {"user_id": uuid4(), "salary_id": uuid4(), "login": f"bench{i}"} for i in range(users)
+    ]
+    async with pool.acquire() as connection:
+        await connection.execute("TRUNCATE TABLE users CASCADE;")
+        await connection.copy_records_to_table(
+            "users",
+            columns=["user_id", "name", "surname", "email", "is_active", "hashed_password", "login", "roles"],
+            records=[
+                (
+                    user["user_id"], "bench", "bench", f"{user['login']}@example.com", True, hashed_password,
+                    user["login"], [PortalRole.ROLE_PORTAL_USER.value],
+                )
+                for user in seeded
+            ],
+        )
+        await connection.copy_records_to_table(
+            "salary_info",
+            columns=["salary_id", "salary", "next_salary_increase", "user_id"],
+            records=[
+                (user["salary_id"], Decimal(1000 + i), date(2030, 1, 1), user["user_id"])
+                for i, user in enumerate(seeded)
+            ],
+        )
+    for user in seeded:
+        user["headers"] = {"Authorization": f"Bearer {create_access_token(data={'sub': user['login']})}"}
+    return seeded
+
+
+def _request(endpoint: str, user: dict) -> dict:
+    if endpoint == "POST /login/token":
+        return {"method": "POST", "url": "/login/token", "data": {"username": user["login"], "password": PASSWORD}}
+    if endpoint == "GET /user/":
+        return {"method": "GET", "url": f"/user/?user_id={user['user_id']}", "headers": user["headers"]}
+    if endpoint == "GET /user/salary":
+        return {"method": "GET", "url": "/user/salary", "headers": user["headers"]}
+    return {
+        "method": "PATCH",
+        "url": f"/user/salary?salary_id={user['salary_id']}",
+        "json": {"salary": random.randint(1000, 100000)},
+        "headers": user["headers"],
+    }
+
+
+def _percentile(ordered: list[float], percent: float) -> float:
+    # nearest-rank
+    index = max(0, math.ceil(percent / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def _summary(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"requests": 0, "errors": errors}
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "rps": round(len(ordered) / elapsed, 1),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(_percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(_percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(_percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+async def _drive(client: httpx.AsyncClient, users: list[dict], concurrency: int, requests: int) -> dict:
+    endpoints, weights = list(WORKLOAD), list(WORKLOAD.values())
+    latencies = {endpoint: [] for endpoint in endpoints}
+    errors = {endpoint: 0 for endpoint in endpoints}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            endpoint = random.choices(endpoints, weights)[0]
+            kwargs = _request(endpoint, random.choice(users))
+            start = time.perf_counter()
+            resp = await client.request(**kwargs)
+            latencies[endpoint].append(time.perf_counter() - start)
+            if resp.status_code >= 400:
+                errors[endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    results = {endpoint: _summary(latencies[endpoint], errors[endpoint], elapsed) for endpoint in endpoints}
+    results["total"] = _summary(
+        [latency for endpoint in endpoints for latency in latencies[endpoint]], sum(errors.values()), elapsed
+    )
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(users: int, concurrency: int, requests: int, base_url: str | None) -> dict:
+    started_at = datetime.utcnow()
+    pool = await asyncpg.create_pool("".join(settings.TEST_DATABASE_URL.split("+asyncpg")))
+    engine = None
+    primary_session_factory = db.session.async_session
+    try:
+        seeded = await _seed(pool, users)
+        if base_url is None:
+            engine = create_async_engine(
+                settings.TEST_DATABASE_URL, future=True, pool_size=concurrency, max_overflow=concurrency
+            )
+            session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+            async def _get_bench_db():
+                session = session_factory()
+                try:
+                    yield session
+                finally:
+                    await session.close()
+
+            # every client logs in from the same address
+            settings.LOGIN_RATE_LIMIT_ENABLED = False
+            app.dependency_overrides[get_db] = _get_bench_db
+            # get_read_db opens its primary sessions without get_db
+            db.session.async_session = session_factory
+            client = httpx.AsyncClient(app=app, base_url="http://bench")
+        else:
+            client = httpx.AsyncClient(
+                base_url=base_url, limits=httpx.Limits(max_connections=concurrency), timeout=30
+            )
+        async with client:
+            results = await _drive(client, seeded, concurrency, requests)
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        db.session.async_session = primary_session_factory
+        await pool.close()
+        if engine is not None:
+            await engine.dispose()
+    return {
+        "started_at": started_at.isoformat(),
+        "commit": _git_commit(),
+        "target": base_url or "in-process",
+        "users": users,
+        "concurrency": concurrency,
+        "workload": WORKLOAD,
+        "settings": {
+            "DB_UNIT_OF_WORK": settings.DB_UNIT_OF_WORK,
+            "FAST_READ_RESPONSES": settings.FAST_READ_RESPONSES,
+            "HASHING_EXECUTOR": settings.HASHING_EXECUTOR,
+            "HASHING_WORKERS": settings.HASHING_WORKERS,
+            "LOGIN_RATE_LIMIT_ENABLED": settings.LOGIN_RATE_LIMIT_ENABLED,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--base-url", default=None)
+    parser.add_argument("--output", default=None, help="JSON file, by default a new one under benchmarks/results/")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.users, args.concurrency, args.requests, args.base_url))
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load_test_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Compare response rendering throughput of the hot read endpoints.
+
+No database needed, the handler results are built in memory:
+
+    python -m benchmarks.responses
+
+``model_json`` is the original path: the ORM object is validated through the
+response_model and rendered by JSONResponse. ``model_orjson`` is the same with
+ORJSONResponse as the app's default class. ``fields_orjson`` is the
+FAST_READ_RESPONSES path: the selected columns go straight to ORJSONResponse.
+Results are responses per second.
+"""
+import asyncio
+import json
+import time
+from datetime import date
+from decimal import Decimal
+from uuid import uuid4
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from api.schemas import ShowUser, ShowSalaryInfo
+from db.models import User, SalaryInfo, PortalRole
+
+REQUESTS = 20000
+REPEAT = 5
+
+
+async def _rate(render) -> float:
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            await render()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return REQUESTS / best
+
+
+async def measure() -> dict:
+    user_id = uuid4()
+    user = User(
+        user_id=user_id, login="login", name="name", surname="surname", email="user@gmail.com",
+        is_active=True, hashed_password="hashed_pass", roles=[PortalRole.ROLE_PORTAL_USER],
+    )
+    user_fields = {
+        "user_id": user_id, "login": "login", "name": "name", "surname": "surname",
+        "email": "user@gmail.com", "is_active": True,
+    }
+    salary_info = SalaryInfo(
+        salary_id=uuid4(), user_id=user_id, salary=Decimal("1234.50"), next_salary_increase=date(2023, 3, 1)
+    )
+    salary_info_fields = {
+        "salary_id": salary_info.salary_id, "user_id": user_id, "salary": 1234.5,
+        "next_salary_increase": date(2023, 3, 1),
+    }
+
+    results = {}
+    for endpoint, model, orm_object, fields in (
+            ("GET /user/", ShowUser, user, user_fields),
+            ("GET /user/salary", ShowSalaryInfo, salary_info, salary_info_fields),
+    ):
+        field = create_response_field(name=f"Response_{model.__name__}", type_=model)
+
+        def through_model(response_class):
+            async def render():
+                content = await serialize_response(field=field, response_content=orm_object, is_coroutine=True)
+                return response_class(content).body
+            return render
+
+        async def fast():
+            return ORJSONResponse(fields).body
+
+        results[endpoint] = {
+            "model_json": round(await _rate(through_model(JSONResponse))),
+            "model_orjson": round(await _rate(through_model(ORJSONResponse))),
+            "fields_orjson": round(await _rate(fast)),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(measure()), indent=2))
@@ -0,0 +1,148 @@
+"""Count database round-trips per endpoint with and without DB_UNIT_OF_WORK.
+
+Runs against TEST_DATABASE_URL, start it with ``make up`` and apply the
+migrations first:
+
+    python -m benchmarks.round_trips
+
+A round-trip is every statement plus the BEGIN and COMMIT/ROLLBACK of each
+transaction that executed at least one statement. The principal and entity
+caches are cleared before every request so every lookup is counted.
+"""
+import asyncio
+import json
+from uuid import uuid4
+
+import asyncpg
+import httpx
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from api.actions.auth import principal_cache
+from db.entity_cache import user_cache, salary_info_cache
+from db.models import PortalRole
+import db.session
+from db.session import get_db
+from main import app
+from security import create_access_token
+
+
+class RoundTripCounter:
+    def __init__(self, engine):
+        self.round_trips = 0
+        self.checkouts = 0
+        self._open = {}
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "begin", self._on_begin)
+        event.listen(sync_engine, "before_cursor_execute", self._on_execute)
+        event.listen(sync_engine, "commit", self._on_end)
+        event.listen(sync_engine, "rollback", self._on_end)
+        event.listen(sync_engine.pool, "checkout", self._on_checkout)
+
+    def reset(self):
+        self.round_trips = 0
+        self.checkouts = 0
+
+    def _on_begin(self, conn):
+        self._open[id(conn)] = False
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._open.get(id(conn)) is False:
+            # asyncpg sends BEGIN lazily together with the first statement
+            self._open[id(conn)] = True
+            self.round_trips += 1
+        self.round_trips += 1
+
+    def _on_end(self, conn):
+        if self._open.pop(id(conn), False):
+            self.round_trips += 1
+
+    def _on_checkout(self, dbapi_conn, conn_record, conn_proxy):
+        self.checkouts += 1
+
+
+async def _seed(pool) -> dict:
+    admin = {"user_id": uuid4(), "login": "bench_admin", "roles": [PortalRole.ROLE_PORTAL_ADMIN]}
+    target = {"user_id": uuid4(), "login": "bench_user", "roles": [PortalRole.ROLE_PORTAL_USER]}
+    salary_id = uuid4()
+    async with pool.acquire() as connection:
+        await connection.execute("TRUNCATE TABLE users CASCADE;")
+        for user in (admin, target):
+            await connection.execute(
+                """INSERT INTO users (user_id, name, surname, email, is_active, hashed_password, login, roles)
+                VALUES ($1, 'bench', 'bench', $2, true, 'hashed_pass', $3, $4)""",
+                user["user_id"], f"{user['login']}@example.com", user["login"], user["roles"],
+            )
+        await connection.execute(
+            """INSERT INTO salary_info (salary_id, salary, next_salary_increase, user_id)
+            VALUES ($1, 1000, '2030-01-01', $2)""",
+            salary_id, target["user_id"],
+        )
+    return {"admin": admin, "target": target, "salary_id": salary_id}
+
+
+def _headers(login: str) -> dict[str, str]:
+    return {"Authorization": f"Bearer {create_access_token(data={'sub': login})}"}
+
+
+SCENARIOS = {
+    "GET /user/": lambda d: ("GET", f"/user/?user_id={d['target']['user_id']}", None),
+    "PATCH /user/": lambda d: ("PATCH", f"/user/?user_id={d['target']['user_id']}", {"name": "patched"}),
+    "DELETE /user/": lambda d: ("DELETE", f"/user/?user_id={d['target']['user_id']}", None),
+    "GET /user/salary": lambda d: ("GET", "/user/salary", None),
+    "POST /user/salary": lambda d: ("POST", "/user/salary", {
+        "user_id": str(d["admin"]["user_id"]), "salary": 500, "next_salary_increase": "2031-01-01",
+    }),
+    "PATCH /user/salary": lambda d: ("PATCH", f"/user/salary?salary_id={d['salary_id']}", {"salary": 2000}),
+    "DELETE /user/salary": lambda d: ("DELETE", f"/user/salary?salary_id={d['salary_id']}", None),
+}
+
+
+async def measure() -> dict:
+    engine = create_async_engine(settings.TEST_DATABASE_URL, future=True)
+    session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    counter = RoundTripCounter(engine)
+
+    async def _get_bench_db():
+        session = session_factory()
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    app.dependency_overrides[get_db] = _get_bench_db
+    # get_read_db opens its primary sessions without get_db
+    primary_session_factory, db.session.async_session = db.session.async_session, session_factory
+    pool = await asyncpg.create_pool("".join(settings.TEST_DATABASE_URL.split("+asyncpg")))
+    results = {}
+    try:
+        async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+            for name, build in SCENARIOS.items():
+                results[name] = {}
+                for mode in (False, True):
+                    settings.DB_UNIT_OF_WORK = mode
+                    data = await _seed(pool)
+                    login = data["target"]["login"] if name == "GET /user/salary" else data["admin"]["login"]
+                    method, url, body = build(data)
+                    principal_cache.clear()
+                    user_cache.clear()
+                    salary_info_cache.clear()
+                    counter.reset()
+                    resp = await client.request(method, url, json=body, headers=_headers(login))
+                    results[name]["unit_of_work" if mode else "per_helper"] = {
+                        "status": resp.status_code,
+                        "round_trips": counter.round_trips,
+                        "checkouts": counter.checkouts,
+                    }
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        db.session.async_session = primary_session_factory
+        await pool.close()
+        await engine.dispose()
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(measure()), indent=2))
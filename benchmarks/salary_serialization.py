@@ -0,0 +1,75 @@
+"""Compare serialization throughput of salary amounts per storage representation.
+
+No database needed, rows are built in memory the way asyncpg hands them over:
+
+    python -m benchmarks.salary_serialization
+
+``float`` is what the export decodes both from the old FLOAT column and from
+NUMERIC cast to float8 in SQL, as it reads now. ``decimal`` is NUMERIC selected
+as-is: a Decimal per value that the encoders stringify, so NDJSON gets a JSON
+string. ``decimal_to_float`` keeps it a JSON number with a ``float(Decimal)`` per
+value in Python. Results are rows per second through the export encoders.
+"""
+import csv
+import io
+import json
+import random
+import timeit
+from datetime import date
+from decimal import Decimal
+from uuid import uuid4
+
+from api.actions.salary_info import _encode_csv_rows, _encode_ndjson_rows
+
+ROWS = 10000
+REPEAT = 5
+COLUMNS = ["salary_id", "user_id", "login", "name", "surname", "email", "salary", "next_salary_increase"]
+
+
+def _rows(salary_type) -> list[tuple]:
+    random.seed(0)
+    rows = []
+    for i in range(ROWS):
+        cents = random.randrange(10000, 100000000)
+        if salary_type is Decimal:
+            salary = Decimal(cents).scaleb(-2)
+        else:
+            salary = cents / 100
+        rows.append((
+            uuid4(), uuid4(), f"login{i}", "name", "surname", f"user{i}@gmail.com", salary, date(2023, 1, 1),
+        ))
+    return rows
+
+
+def _best_rate(func, items: int) -> float:
+    return items / min(timeit.repeat(func, number=1, repeat=REPEAT))
+
+
+def measure() -> dict:
+    results = {}
+    float_rows, decimal_rows = _rows(float), _rows(Decimal)
+
+    def to_float(rows):
+        return [(*row[:6], float(row[6]), row[7]) for row in rows]
+
+    variants = (
+        ("float", float_rows, lambda rows: rows),
+        ("decimal", decimal_rows, lambda rows: rows),
+        ("decimal_to_float", decimal_rows, to_float),
+    )
+    for name, rows, convert in variants:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        results[name] = {
+            "csv_rows_per_sec": round(
+                _best_rate(lambda: _encode_csv_rows(convert(rows), writer, buffer), ROWS)
+            ),
+            "ndjson_rows_per_sec": round(
+                _best_rate(lambda: _encode_ndjson_rows(COLUMNS, convert(rows)), ROWS)
+            ),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(measure(), indent=2))
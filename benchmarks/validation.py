@@ -0,0 +1,66 @@
+"""Validation throughput per bulk schema: Pydantic models against api.validation.
+
+No database needed:
+
+    python -m benchmarks.validation
+
+For each schema a valid and an invalid payload (every validated field wrong)
+are run through the Pydantic model, which raises at the first bad field, and
+through the one-pass validator, which reports every field without raising.
+Results are payloads per second.
+"""
+import json
+import timeit
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from api.schemas import UserCreate, SalaryInfoCreate
+from api.validation import validate_user_create, validate_salary_info_create
+
+NUMBER = 20000
+REPEAT = 5
+
+CASES = {
+    "UserCreate": (
+        UserCreate,
+        validate_user_create,
+        {"login": "login", "name": "Name", "surname": "Surname", "email": "user@gmail.com", "password": "pass"},
+        {"login": "login", "name": "Name1", "surname": "Surname1", "email": "user", "password": "pass"},
+    ),
+    "SalaryInfoCreate": (
+        SalaryInfoCreate,
+        validate_salary_info_create,
+        {"user_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6", "salary": "1234.50", "next_salary_increase": "2023-06-01"},
+        {"user_id": "user", "salary": "12.345", "next_salary_increase": "01-06-2023"},
+    ),
+}
+
+
+def _rate(func) -> float:
+    return NUMBER / min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+
+
+def _through_model(schema, payload):
+    def run():
+        try:
+            schema(**payload)
+        except (ValidationError, HTTPException):
+            pass
+    return run
+
+
+def measure() -> dict:
+    results = {}
+    for name, (schema, validate, valid, invalid) in CASES.items():
+        results[name] = {
+            "pydantic_valid": round(_rate(_through_model(schema, valid))),
+            "one_pass_valid": round(_rate(lambda: validate(valid))),
+            "pydantic_invalid": round(_rate(_through_model(schema, invalid))),
+            "one_pass_invalid": round(_rate(lambda: validate(invalid))),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(measure(), indent=2))
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """Bounded in-process LRU cache whose entries also expire after a TTL.
+
+    Entries can carry a tag (e.g. a user_id) so that every key derived from
+    the same entity can be dropped at once with ``invalidate_tag``.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[Any, float, Hashable]] = OrderedDict()
+        self._tags: dict[Hashable, set[Hashable]] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None, tag: Hashable = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (value, time.monotonic() + ttl, tag)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+
+    def delete(self, key: Hashable) -> None:
+        if key in self._data:
+            self._remove(key)
+
+    def invalidate_tag(self, tag: Hashable) -> None:
+        for key in list(self._tags.get(tag, ())):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tag = self._data.pop(key)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+_invalidation_hooks: dict[str, list[Callable[[Hashable], None]]] = {}
+
+
+def on_invalidate(entity: str, hook: Callable[[Hashable], None]) -> None:
+    """Register ``hook`` to be called with the key of every changed ``entity``."""
+    _invalidation_hooks.setdefault(entity, []).append(hook)
+
+
+def invalidate(entity: str, key: Hashable) -> None:
+    """Drop cached state derived from ``entity`` identified by ``key``."""
+    for hook in _invalidation_hooks.get(entity, ()):
+        hook(key)
+
+
+_flush_hooks: list[Callable[[], None]] = []
+
+
+def on_flush(hook: Callable[[], None]) -> None:
+    """Register ``hook`` to drop everything a cache holds, see ``flush``."""
+    _flush_hooks.append(hook)
+
+
+def flush() -> None:
+    """Drop all cached state derived from the database, when invalidations may have been missed."""
+    for hook in _flush_hooks:
+        hook()
@@ -1,13 +1,88 @@
+from datetime import date, datetime
+from decimal import Decimal
 from enum import Enum
 
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncResult
 from uuid import UUID
-from sqlalchemy import update, and_, select, delete
+from sqlalchemy import update, and_, select, delete, event, or_, not_, true, any_, bindparam, func, case, \
+    literal_column, tuple_, cast, Float, String
+from sqlalchemy.dialects.postgresql import insert, array, ARRAY, UUID as PG_UUID
+from sqlalchemy.orm import Session
 
-from db.models import User, SalaryInfo
+import settings
+from cache import invalidate
+from db.invalidation_bus import bus
+from db.session import note_write
+from profiling import attribute_statements
+from db.models import User, SalaryInfo, SalaryStatsBucket, SalaryIncreaseMonth, SalaryPercentiles
 from db.models import PortalRole
 
 
+def _invalidate(session: AsyncSession, entity: str, key: UUID) -> None:
+    # Evict now and once more after commit, so a concurrent reader can't
+    # re-cache the pre-commit row in between.
+    invalidate(entity, key)
+    session.info.setdefault("pending_invalidations", set()).add((entity, key))
+
+
+@event.listens_for(Session, "before_commit")
+def _publish_invalidations(session: Session) -> None:
+    # part of the transaction, other workers get it exactly when the change commits
+    events = session.info.get("pending_invalidations")
+    if settings.INVALIDATION_BUS_ENABLED and events:
+        session.execute(select(*(
+            func.pg_notify(bus.channel, payload) for payload in bus.payloads(sorted(events))
+        )))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session) -> None:
+    events = session.info.pop("pending_invalidations", ())
+    if events:
+        note_write(session)
+    for entity, key in events:
+        invalidate(entity, key)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session: Session) -> None:
+    session.info.pop("pending_invalidations", None)
+
+
+SALARY_PERCENTILES = (0.25, 0.5, 0.75, 0.9, 0.99)
+
+
+def _add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def _salary_percentiles_expression():
+    # Postgres interpolates percentiles in double precision anyway. Ordering by
+    # the NUMERIC column would make SQLAlchemy convert the returned array as one Decimal
+    return func.percentile_cont(array(SALARY_PERCENTILES)).within_group(cast(SalaryInfo.salary, Float))
+
+
+def _name_percentiles(values) -> dict[str, float]:
+    return {f"p{round(p * 100)}": float(value) for p, value in zip(SALARY_PERCENTILES, values or ())}
+
+
+def permitted_target_clause(cur_user: User):
+    """SQL counterpart of ``check_user_permissions`` with ``User`` as the target."""
+    if not {PortalRole.ROLE_PORTAL_ADMIN, PortalRole.ROLE_PORTAL_SUPERUSER}.intersection(cur_user.roles):
+        return User.user_id == cur_user.user_id
+    if PortalRole.ROLE_PORTAL_ADMIN not in cur_user.roles:
+        return true()
+    return or_(
+        User.user_id == cur_user.user_id,
+        not_(or_(
+            User.roles.any(PortalRole.ROLE_PORTAL_SUPERUSER.value),
+            User.roles.any(PortalRole.ROLE_PORTAL_ADMIN.value),
+        )),
+    )
+
+
+@attribute_statements
 class UserDAL:
     def __init__(self, db_session: AsyncSession):
         self.db_session = db_session
@@ -27,12 +102,32 @@ class UserDAL:
         await self.db_session.flush()
         return new_user
 
+    async def create_users_bulk(self, users: list[dict]) -> dict[str, UUID]:
+        """Multi-row INSERT that skips rows hitting a unique constraint.
+
+        Returns login -> user_id of the rows actually inserted.
+        """
+        if not users:
+            return {}
+        query = insert(User).values(users).on_conflict_do_nothing().returning(User.login, User.user_id)
+        res = await self.db_session.execute(query)
+        return {login: user_id for login, user_id in res.fetchall()}
+
+    async def get_taken_logins_and_emails(
+            self, logins: list[str], emails: list[str]
+    ) -> tuple[set[str], set[str]]:
+        query = select(User.login, User.email).where(or_(User.login.in_(logins), User.email.in_(emails)))
+        res = await self.db_session.execute(query)
+        rows = res.fetchall()
+        return {row.login for row in rows}, {row.email for row in rows}
+
     async def delete_user(self, user_id: UUID) -> UUID | None:
-        query = update(User).where(and_(User.user_id == user_id, User.is_active == True)).values(is_active=False). \
-            returning(User.user_id)
+        query = update(User).where(and_(User.user_id == user_id, User.is_active == True)) \
+            .values(is_active=False, token_version=User.token_version + 1).returning(User.user_id)
         res = await self.db_session.execute(query)
         deleted_user_id_row = res.fetchone()
         if deleted_user_id_row is not None:
+            _invalidate(self.db_session, "user", deleted_user_id_row[0])
             return deleted_user_id_row[0]
 
     async def get_user_by_id(self, user_id: UUID) -> User | None:
@@ -42,6 +137,57 @@ class UserDAL:
         if user_row is not None:
             return user_row[0]
 
+    async def get_user_fields_by_id(self, user_id: UUID) -> dict | None:
+        """Plain ``ShowUser`` columns of a user, no ORM object is built.
+
+        Ids come as text, orjson doesn't serialize asyncpg's UUID subclass.
+        """
+        query = select(
+            cast(User.user_id, String).label("user_id"), User.login, User.name, User.surname, User.email,
+            User.is_active,
+        ).where(User.user_id == user_id)
+        res = await self.db_session.execute(query)
+        user_row = res.mappings().first()
+        if user_row is not None:
+            return dict(user_row)
+
+    async def get_users_by_ids(self, user_ids: list[UUID]) -> list[User]:
+        # one array parameter keeps a single prepared statement for any batch size
+        query = select(User).where(
+            User.user_id == any_(bindparam("user_ids", user_ids, type_=ARRAY(PG_UUID(as_uuid=True))))
+        )
+        res = await self.db_session.execute(query)
+        return list(res.scalars())
+
+    async def list_users(
+            self,
+            limit: int,
+            after_user_id: UUID | None = None,
+            is_active: bool | None = None,
+            role: PortalRole | None = None,
+            name_prefix: str | None = None,
+    ) -> list[User]:
+        """Page of users ordered by user_id, continuing after ``after_user_id`` (keyset, no OFFSET)."""
+        query = select(User).order_by(User.user_id).limit(limit)
+        if after_user_id is not None:
+            query = query.where(User.user_id > after_user_id)
+        if is_active is not None:
+            query = query.where(User.is_active == is_active)
+        if role is not None:
+            query = query.where(User.roles.op("@>")(array([role.value])))
+        if name_prefix:
+            # a ready-made pattern instead of LIKE :prefix || '%' lets the planner use the pattern index
+            pattern = name_prefix.replace("/", "//").replace("%", "/%").replace("_", "/_") + "%"
+            query = query.where(User.name.like(pattern, escape="/"))
+        res = await self.db_session.execute(query)
+        return list(res.scalars())
+
+    async def get_token_version(self, user_id: UUID) -> int | None:
+        """Current token_version of an active user, None for a missing or deactivated one."""
+        query = select(User.token_version).where(and_(User.user_id == user_id, User.is_active == True))
+        res = await self.db_session.execute(query)
+        return res.scalar()
+
     async def get_user_by_login(self, login: str) -> User | None:
         query = select(User).where(User.login == login)
         res = await self.db_session.execute(query)
@@ -50,14 +196,17 @@ class UserDAL:
             return user_row[0]
 
     async def update_user(self, user_id=UUID, **kwargs) -> UUID | None:
+        if "roles" in kwargs or "is_active" in kwargs:
+            kwargs["token_version"] = User.token_version + 1
         query = update(User).where(and_(User.user_id == user_id, User.is_active == True)).values(kwargs) \
             .returning(User.user_id)
         res = await self.db_session.execute(query)
         update_user_row = res.fetchone()
         if update_user_row is not None:
+            _invalidate(self.db_session, "user", update_user_row[0])
             return update_user_row[0]
 
-    async def create_salary_info(self, user_id: UUID, salary: str, next_salary_increase: str):
+    async def create_salary_info(self, user_id: UUID, salary: Decimal, next_salary_increase: date):
         new_salary_info = SalaryInfo(
             user_id=user_id,
             salary=salary,
@@ -65,6 +214,7 @@ class UserDAL:
         )
         self.db_session.add(new_salary_info)
         await self.db_session.flush()
+        _invalidate(self.db_session, "salary_info", user_id)
         return new_salary_info
 
     async def get_salary_info_by_user_id(self, user_id: UUID) -> SalaryInfo | None:
@@ -74,23 +224,262 @@ class UserDAL:
         if salary_info_row is not None:
             return salary_info_row[0]
 
-    async def get_salary_info_by_salary_id(self, salary_id: UUID) -> SalaryInfo | None:
-        query = select(SalaryInfo).where(SalaryInfo.salary_id == salary_id)
+    async def get_salary_info_fields_by_user_id(self, user_id: UUID) -> dict | None:
+        """Plain ``ShowSalaryInfo`` columns, ids as text and the salary as a float (see stream_salary_export)."""
+        query = select(
+            cast(SalaryInfo.salary_id, String).label("salary_id"),
+            cast(SalaryInfo.user_id, String).label("user_id"),
+            cast(SalaryInfo.salary, Float).label("salary"),
+            SalaryInfo.next_salary_increase,
+        ).where(SalaryInfo.user_id == user_id)
         res = await self.db_session.execute(query)
-        salary_info_row = res.fetchone()
+        salary_info_row = res.mappings().first()
         if salary_info_row is not None:
-            return salary_info_row[0]
+            return dict(salary_info_row)
 
-    async def update_salary_info(self, salary_id: UUID, **kwargs) -> UUID | None:
-        query = update(SalaryInfo).where(SalaryInfo.salary_id == salary_id).values(kwargs) \
-            .returning(SalaryInfo.salary_id)
+    async def get_salary_infos_with_users_by_user_ids(self, user_ids: list[UUID]) -> list[tuple[SalaryInfo, User]]:
+        """Salary infos of ``user_ids`` with their users, for permission checks without another query."""
+        query = select(SalaryInfo, User).join(User, SalaryInfo.user_id == User.user_id).where(
+            SalaryInfo.user_id == any_(bindparam("user_ids", user_ids, type_=ARRAY(PG_UUID(as_uuid=True))))
+        )
         res = await self.db_session.execute(query)
-        update_user_row = res.fetchone()
-        if update_user_row is not None:
-            return update_user_row[0]
+        return [tuple(row) for row in res]
+
+    async def list_salary_increases_due(
+            self,
+            cur_user: User,
+            date_from: date,
+            date_to: date,
+            limit: int,
+            after: tuple[date, UUID] | None = None,
+    ) -> list[SalaryInfo]:
+        """Salary info with ``next_salary_increase`` in [date_from, date_to], soonest first.
+
+        Ordered by (next_salary_increase, salary_id) so the range, the order and the
+        keyset continuation are all served by ``ix_salary_info_next_salary_increase``.
+        """
+        query = select(SalaryInfo).join(User, User.user_id == SalaryInfo.user_id).where(and_(
+            SalaryInfo.next_salary_increase >= date_from,
+            SalaryInfo.next_salary_increase <= date_to,
+            permitted_target_clause(cur_user),
+        )).order_by(SalaryInfo.next_salary_increase, SalaryInfo.salary_id).limit(limit)
+        if after is not None:
+            query = query.where(tuple_(SalaryInfo.next_salary_increase, SalaryInfo.salary_id) > tuple_(*after))
+        res = await self.db_session.execute(query)
+        return list(res.scalars())
+
+    def _permitted_salary_info_cte(self, salary_id: UUID, cur_user: User):
+        return (
+            select(SalaryInfo.salary_id, permitted_target_clause(cur_user).label("permitted"))
+            .join(User, User.user_id == SalaryInfo.user_id)
+            .where(SalaryInfo.salary_id == salary_id)
+            .cte("target")
+        )
+
+    async def update_salary_info_if_permitted(
+            self, salary_id: UUID, cur_user: User, **kwargs
+    ) -> tuple[UUID | None, UUID | None]:
+        """Check ownership/roles and update in one statement.
+
+        Returns ``(found_salary_id, updated_salary_id)``, the first one is None
+        when the salary info doesn't exist, the second when it is forbidden.
+        """
+        target = self._permitted_salary_info_cte(salary_id, cur_user)
+        updated = update(SalaryInfo).where(
+            and_(SalaryInfo.salary_id == target.c.salary_id, target.c.permitted)
+        ).values(kwargs).returning(SalaryInfo.salary_id, SalaryInfo.user_id).cte("updated")
+        query = select(target.c.salary_id, updated.c.salary_id, updated.c.user_id).outerjoin(updated, true())
+        res = await self.db_session.execute(query)
+        row = res.fetchone()
+        if row is None:
+            return None, None
+        if row[1] is not None:
+            _invalidate(self.db_session, "salary_info", row[2])
+        return row[0], row[1]
+
+    async def delete_salary_info_if_permitted(
+            self, salary_id: UUID, cur_user: User
+    ) -> tuple[UUID | None, UUID | None]:
+        """Same as ``update_salary_info_if_permitted`` but deletes the row."""
+        target = self._permitted_salary_info_cte(salary_id, cur_user)
+        deleted = delete(SalaryInfo).where(
+            and_(SalaryInfo.salary_id == target.c.salary_id, target.c.permitted)
+        ).returning(SalaryInfo.salary_id, SalaryInfo.user_id).cte("deleted")
+        query = select(target.c.salary_id, deleted.c.salary_id, deleted.c.user_id).outerjoin(deleted, true())
+        res = await self.db_session.execute(query)
+        row = res.fetchone()
+        if row is None:
+            return None, None
+        if row[1] is not None:
+            _invalidate(self.db_session, "salary_info", row[2])
+        return row[0], row[1]
+
+    async def upsert_salary_infos(self, salary_infos: list[dict]) -> dict[UUID, UUID]:
+        """Multi-row ``INSERT ... ON CONFLICT (user_id) DO UPDATE``.
 
-    async def delete_salary_info(self, salary_id: UUID) -> UUID | None:
-        query = delete(SalaryInfo).where(SalaryInfo.salary_id == salary_id).returning(SalaryInfo.salary_id)
+        Returns user_id -> salary_id of every written row.
+        """
+        if not salary_infos:
+            return {}
+        query = insert(SalaryInfo).values(salary_infos)
+        query = query.on_conflict_do_update(
+            index_elements=[SalaryInfo.user_id],
+            set_={
+                "salary": query.excluded.salary,
+                "next_salary_increase": query.excluded.next_salary_increase,
+            },
+        ).returning(SalaryInfo.user_id, SalaryInfo.salary_id)
         res = await self.db_session.execute(query)
-        if res is not None:
-            return salary_id
+        upserted = {user_id: salary_id for user_id, salary_id in res.fetchall()}
+        for user_id in upserted:
+            _invalidate(self.db_session, "salary_info", user_id)
+        return upserted
+
+    async def stream_salary_export(self, cur_user: User, batch_size: int) -> AsyncResult:
+        """Salary info joined to its owner over a server-side cursor, plain rows without ORM objects."""
+        query = select(
+            SalaryInfo.salary_id,
+            SalaryInfo.user_id,
+            User.login,
+            User.name,
+            User.surname,
+            User.email,
+            # NUMERIC(14, 2) fits the 15 significant digits a float8 round-trips, so its shortest
+            # repr prints the exact amount back, and asyncpg decodes it without a Decimal
+            cast(SalaryInfo.salary, Float).label("salary"),
+            SalaryInfo.next_salary_increase,
+        ).join(User, User.user_id == SalaryInfo.user_id).where(
+            permitted_target_clause(cur_user)
+        ).execution_options(yield_per=batch_size)
+        return await self.db_session.stream(query)
+
+    async def compute_salary_stats(self, buckets: int, months_ahead: int) -> dict:
+        """Org-wide salary analytics, every aggregate is computed by Postgres."""
+        summary_query = select(
+            func.count(SalaryInfo.salary_id),
+            func.avg(SalaryInfo.salary),
+            func.min(SalaryInfo.salary),
+            func.max(SalaryInfo.salary),
+            _salary_percentiles_expression(),
+        )
+        count, mean, lowest, highest, percentiles = (await self.db_session.execute(summary_query)).one()
+
+        histogram = []
+        if count:
+            bounds = select(
+                func.min(SalaryInfo.salary).label("lo"), func.max(SalaryInfo.salary).label("hi")
+            ).cte("bounds")
+            # width_bucket puts the maximum into bucket n + 1, fold it into the last one
+            bucket = case(
+                (bounds.c.hi == bounds.c.lo, 1),
+                else_=func.least(func.width_bucket(SalaryInfo.salary, bounds.c.lo, bounds.c.hi, buckets), buckets),
+            ).label("bucket")
+            # group by the output name, a repeated expression would get different bind parameters
+            histogram_query = select(bucket, func.count()).select_from(SalaryInfo).join(bounds, true()) \
+                .group_by(literal_column("bucket")).order_by(literal_column("bucket"))
+            counts = dict((await self.db_session.execute(histogram_query)).all())
+            width = (highest - lowest) / buckets
+            histogram = [
+                {"lower": lowest + width * i, "upper": lowest + width * (i + 1), "count": counts.get(i + 1, 0)}
+                for i in range(buckets)
+            ]
+
+        today = date.today()
+        month = func.to_char(SalaryInfo.next_salary_increase, "YYYY-MM").label("month")
+        upcoming_query = select(month, func.count()).where(and_(
+            SalaryInfo.next_salary_increase >= today,
+            SalaryInfo.next_salary_increase < _add_months(today, months_ahead),
+        )).group_by(literal_column("month")).order_by(literal_column("month"))
+        upcoming = [
+            {"month": row[0], "count": row[1]} for row in (await self.db_session.execute(upcoming_query)).all()
+        ]
+
+        return {
+            "count": count,
+            "mean": mean,
+            "min": lowest,
+            "max": highest,
+            "percentiles": _name_percentiles(percentiles),
+            "histogram": histogram,
+            "upcoming_increases": upcoming,
+            "computed_at": datetime.utcnow(),
+        }
+
+    async def compute_salary_percentiles(self) -> dict[str, float]:
+        query = select(_salary_percentiles_expression())
+        return _name_percentiles((await self.db_session.execute(query)).scalar())
+
+    async def get_salary_stats_rollup(self, bucket_width: int, months_ahead: int) -> dict:
+        """Analytics from the trigger-maintained counters (see ``SALARY_STATS_DDL``), salary_info isn't scanned.
+
+        Percentiles come from the last background refresh, or are computed once
+        without any locks before the first one.
+        """
+        buckets = (await self.db_session.execute(
+            select(
+                SalaryStatsBucket.bucket,
+                SalaryStatsBucket.count,
+                SalaryStatsBucket.total,
+                SalaryStatsBucket.min_salary,
+                SalaryStatsBucket.max_salary,
+            ).where(SalaryStatsBucket.count > 0).order_by(SalaryStatsBucket.bucket)
+        )).all()
+        count = sum(row.count for row in buckets)
+
+        # the window moves with today, so it is applied here and not kept in the counters
+        today = date.today()
+        next_month = _add_months(today, 1)
+        upcoming = []
+        if months_ahead > 0:
+            # the current month is partly over, count it from ix_salary_info_next_salary_increase
+            current = (await self.db_session.execute(select(func.count()).where(and_(
+                SalaryInfo.next_salary_increase >= today,
+                SalaryInfo.next_salary_increase < next_month,
+            )))).scalar()
+            if current:
+                upcoming.append({"month": today.strftime("%Y-%m"), "count": current})
+        months_query = select(SalaryIncreaseMonth.month, SalaryIncreaseMonth.count).where(and_(
+            SalaryIncreaseMonth.month >= next_month,
+            SalaryIncreaseMonth.month < _add_months(today, months_ahead),
+            SalaryIncreaseMonth.count > 0,
+        )).order_by(SalaryIncreaseMonth.month)
+        upcoming.extend(
+            {"month": month.strftime("%Y-%m"), "count": month_count}
+            for month, month_count in (await self.db_session.execute(months_query)).all()
+        )
+
+        stored = (await self.db_session.execute(
+            select(SalaryPercentiles.percentiles, SalaryPercentiles.refreshed_at)
+            .where(SalaryPercentiles.percentiles_id == 1)
+        )).first()
+        if stored is not None:
+            percentiles, percentiles_refreshed_at = stored
+        else:
+            percentiles, percentiles_refreshed_at = await self.compute_salary_percentiles(), None
+
+        return {
+            "count": count,
+            "mean": sum(row.total for row in buckets) / count if count else None,
+            "min": min(row.min_salary for row in buckets) if count else None,
+            "max": max(row.max_salary for row in buckets) if count else None,
+            "percentiles": percentiles,
+            "histogram": [
+                {"lower": row.bucket * bucket_width, "upper": (row.bucket + 1) * bucket_width, "count": row.count}
+                for row in buckets
+            ],
+            "upcoming_increases": upcoming,
+            "computed_at": datetime.utcnow(),
+            "percentiles_refreshed_at": percentiles_refreshed_at,
+        }
+
+    async def refresh_salary_percentiles(self) -> None:
+        """Store fresh percentiles, salary writers never wait on this."""
+        percentiles = await self.compute_salary_percentiles()
+        query = insert(SalaryPercentiles).values(
+            percentiles_id=1, percentiles=percentiles, refreshed_at=datetime.utcnow()
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[SalaryPercentiles.percentiles_id],
+            set_={"percentiles": query.excluded.percentiles, "refreshed_at": query.excluded.refreshed_at},
+        )
+        await self.db_session.execute(query)
@@ -0,0 +1,162 @@
+"""Read-through cache of user and salary info rows.
+
+Entries are frozen snapshots of the row, never live ORM instances, so one
+entry can be shared by concurrent requests and pickled by a shared backend.
+Writes in ``UserDAL`` invalidate them synchronously through ``cache.invalidate``
+(see ``db.dals._invalidate``), once when the statement runs and once after
+commit. Reads inside a unit of work bypass the cache: they may need their own
+uncommitted writes, and those must never be cached. Rows read from a replica
+are served but not cached: a replica may still return a row that an
+invalidation has already evicted, and nothing would evict it again.
+"""
+import functools
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+from typing import Any, Callable, Hashable
+from uuid import UUID
+
+import settings
+from cache import TTLCache, on_invalidate, on_flush
+from db.models import User, SalaryInfo, PortalRole
+from db.session import in_unit_of_work, is_replica
+from metrics import ENTITY_CACHE_LOOKUPS
+
+_MISS = object()
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    user_id: UUID
+    login: str
+    name: str
+    surname: str
+    email: str
+    is_active: bool
+    roles: tuple[str, ...]
+    token_version: int
+
+    @classmethod
+    def from_model(cls, user: User) -> "UserSnapshot":
+        return cls(
+            user_id=user.user_id,
+            login=user.login,
+            name=user.name,
+            surname=user.surname,
+            email=user.email,
+            is_active=user.is_active,
+            roles=tuple(user.roles),
+            token_version=user.token_version,
+        )
+
+    @property
+    def is_superuser(self) -> bool:
+        return PortalRole.ROLE_PORTAL_SUPERUSER in self.roles
+
+    @property
+    def is_admin(self) -> bool:
+        return PortalRole.ROLE_PORTAL_ADMIN in self.roles
+
+    def add_admin_privileges_for_user(self):
+        if not self.is_admin:
+            return {*self.roles, PortalRole.ROLE_PORTAL_ADMIN}
+
+
+@dataclass(frozen=True, slots=True)
+class SalaryInfoSnapshot:
+    salary_id: UUID
+    user_id: UUID
+    salary: Decimal
+    next_salary_increase: date
+
+    @classmethod
+    def from_model(cls, salary_info: SalaryInfo) -> "SalaryInfoSnapshot":
+        return cls(
+            salary_id=salary_info.salary_id,
+            user_id=salary_info.user_id,
+            salary=salary_info.salary,
+            next_salary_increase=salary_info.next_salary_increase,
+        )
+
+
+class EntityCacheBackend(ABC):
+    """Storage of snapshots, a shared store (e.g. Redis) implements the same calls.
+
+    Invalidation runs inside commit hooks, so ``invalidate_tag`` must not block.
+    """
+
+    @abstractmethod
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        ...
+
+    @abstractmethod
+    def set(self, key: Hashable, value: Any, ttl: float | None = None, tag: Hashable = None) -> None:
+        ...
+
+    @abstractmethod
+    def invalidate_tag(self, tag: Hashable) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class MemoryEntityCacheBackend(TTLCache, EntityCacheBackend):
+    """Per-process LRU + TTL backend."""
+
+
+class EntityCache:
+    """Snapshots of one entity, tagged with the key ``cache.invalidate`` is called with."""
+
+    def __init__(self, entity: str, backend: EntityCacheBackend):
+        self.entity = entity
+        self.backend = backend
+        # bumped by every invalidation, a load that raced with one isn't stored
+        self.generation = 0
+        on_invalidate(entity, self.invalidate)
+        on_flush(self.clear)
+
+    def invalidate(self, tag: Hashable) -> None:
+        self.generation += 1
+        self.backend.invalidate_tag(tag)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.backend.clear()
+
+
+def read_through(cache: EntityCache, name: str, tag_of: Callable[[Any, Any], Hashable | None]):
+    """Decorator for ``helper(key, db)`` read helpers returning a snapshot or None.
+
+    ``tag_of(key, snapshot)`` gives the invalidation tag of a result, or None
+    when the result shouldn't be cached (e.g. a miss no write would invalidate).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(key, db):
+            if not settings.ENTITY_CACHE_ENABLED or in_unit_of_work(db):
+                return await func(key, db)
+            cache_key = (name, key)
+            value = cache.backend.get(cache_key, _MISS)
+            if value is not _MISS:
+                ENTITY_CACHE_LOOKUPS.labels(name, "hit").inc()
+                return value
+            ENTITY_CACHE_LOOKUPS.labels(name, "miss").inc()
+            generation = cache.generation
+            value = await func(key, db)
+            tag = tag_of(key, value)
+            if tag is not None and cache.generation == generation and not is_replica(db):
+                cache.backend.set(cache_key, value, tag=tag)
+            return value
+        return wrapper
+    return decorator
+
+
+user_cache = EntityCache(
+    "user", MemoryEntityCacheBackend(maxsize=settings.ENTITY_CACHE_SIZE, ttl=settings.ENTITY_CACHE_TTL_SECONDS)
+)
+salary_info_cache = EntityCache(
+    "salary_info", MemoryEntityCacheBackend(maxsize=settings.ENTITY_CACHE_SIZE, ttl=settings.ENTITY_CACHE_TTL_SECONDS)
+)
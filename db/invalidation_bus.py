@@ -0,0 +1,131 @@
+"""Cross-worker cache invalidation over Postgres LISTEN/NOTIFY.
+
+Every transaction that changed cached entities (``db.dals._invalidate``)
+sends them with ``pg_notify`` right before it commits, so the notification is
+delivered exactly when the change becomes visible and never for a rollback.
+Each worker listens on INVALIDATION_BUS_CHANNEL and passes the events to
+``cache.invalidate``, the same hooks a local write runs.
+
+Notifications carry the publishing worker's id and a sequence number. A
+number that is still missing after INVALIDATION_BUS_GAP_TIMEOUT_SECONDS
+(concurrent transactions of one worker may commit out of order) means an
+event was lost, and the worker drops all of its caches with ``cache.flush``.
+It does the same whenever the listening connection is (re)established, as
+anything sent while it was down is lost. Until a dropped connection is back,
+entries can only be as stale as their TTL.
+"""
+import asyncio
+import itertools
+import json
+import time
+from logging import getLogger
+from uuid import UUID, uuid4
+
+import asyncpg
+
+import settings
+from cache import invalidate, flush
+from metrics import INVALIDATION_BUS_MESSAGES, INVALIDATION_BUS_FLUSHES
+
+logger = getLogger(__name__)
+
+# pg_notify payloads are limited to 8000 bytes
+EVENTS_PER_NOTIFICATION = 100
+
+
+class InvalidationBus:
+    def __init__(self, dsn: str, channel: str, gap_timeout: float, reconnect_delay: float):
+        self.dsn = dsn
+        self.channel = channel
+        self.gap_timeout = gap_timeout
+        self.reconnect_delay = reconnect_delay
+        self.publisher_id = uuid4().hex
+        self._sequence = itertools.count(1)
+        # publisher id -> last sequence number received
+        self._last_sequence: dict[str, int] = {}
+        # (publisher id, sequence number) -> deadline to arrive
+        self._missing: dict[tuple[str, int], float] = {}
+        self._task: asyncio.Task | None = None
+
+    def payloads(self, events: list[tuple[str, UUID]]) -> list[str]:
+        """Notification payloads for ``(entity, key)`` events, each with the next sequence number."""
+        return [
+            json.dumps({
+                "publisher": self.publisher_id,
+                "sequence": next(self._sequence),
+                "events": [[entity, str(key)] for entity, key in events[start:start + EVENTS_PER_NOTIFICATION]],
+            })
+            for start in range(0, len(events), EVENTS_PER_NOTIFICATION)
+        ]
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        message = json.loads(payload)
+        publisher, sequence = message["publisher"], message["sequence"]
+        if publisher == self.publisher_id:
+            # already applied by the local write
+            INVALIDATION_BUS_MESSAGES.labels("own").inc()
+            return
+        last = self._last_sequence.get(publisher)
+        if last is None or sequence > last:
+            for missing in range(last + 1 if last is not None else sequence, sequence):
+                self._missing[(publisher, missing)] = time.monotonic() + self.gap_timeout
+            self._last_sequence[publisher] = sequence
+        else:
+            self._missing.pop((publisher, sequence), None)
+        INVALIDATION_BUS_MESSAGES.labels("applied").inc()
+        for entity, key in message["events"]:
+            invalidate(entity, UUID(key))
+
+    def _flush(self, reason: str) -> None:
+        logger.warning("Flushing caches, invalidation bus %s", reason)
+        INVALIDATION_BUS_FLUSHES.labels(reason).inc()
+        self._last_sequence.clear()
+        self._missing.clear()
+        flush()
+
+    def _check_gaps(self) -> None:
+        now = time.monotonic()
+        if any(deadline <= now for deadline in self._missing.values()):
+            self._flush("gap")
+
+    async def listen(self) -> None:
+        """Listen until cancelled, reconnecting after any connection failure."""
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                await connection.add_listener(self.channel, self._on_notification)
+                self._flush("reconnect")
+                while True:
+                    await asyncio.sleep(self.gap_timeout)
+                    self._check_gaps()
+                    # a dead connection delivers nothing and raises nothing, probe it
+                    await connection.fetchval("SELECT 1", timeout=self.reconnect_delay + self.gap_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("Invalidation bus connection lost: %s", err)
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.terminate()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+bus = InvalidationBus(
+    dsn="".join(settings.REAL_DATABASE_URL.split("+asyncpg")),
+    channel=settings.INVALIDATION_BUS_CHANNEL,
+    gap_timeout=settings.INVALIDATION_BUS_GAP_TIMEOUT_SECONDS,
+    reconnect_delay=settings.INVALIDATION_BUS_RECONNECT_SECONDS,
+)
@@ -1,11 +1,14 @@
 from enum import Enum
 
-from sqlalchemy import Column, Boolean, String, ForeignKey, ARRAY, FLOAT
+from sqlalchemy import Column, Boolean, String, ForeignKey, ARRAY, Index, Integer, DateTime, Date, Numeric, \
+    BigInteger, DDL, event
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 
 import uuid
 
+import settings
+
 Base = declarative_base()
 
 
@@ -26,9 +29,20 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     hashed_password = Column(String, nullable=False)
     roles = Column(ARRAY(String), nullable=False)
+    # bumped whenever roles or is_active change, stateless tokens signed with an older one are revoked
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     salary_info = relationship("SalaryInfo", back_populates="user")
 
+    __table_args__ = (
+        # role filter (roles @> ARRAY[...]) in the user listing
+        Index("ix_users_roles", "roles", postgresql_using="gin"),
+        # name prefix filter (name LIKE 'prefix%') in the user listing
+        Index("ix_users_name_pattern", "name", postgresql_ops={"name": "text_pattern_ops"}),
+        # keyset pagination over active/inactive users
+        Index("ix_users_is_active_user_id", "is_active", "user_id"),
+    )
+
     @property
     def is_superuser(self) -> bool:
         return PortalRole.ROLE_PORTAL_SUPERUSER in self.roles
@@ -47,16 +61,113 @@ class SalaryInfo(Base):
 
     salary_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.user_id"), unique=True)
-    salary = Column(FLOAT, nullable=False)
-    next_salary_increase = Column(String, nullable=False)
+    salary = Column(Numeric(14, 2), nullable=False)
+    next_salary_increase = Column(Date, nullable=False)
 
     user = relationship("User", back_populates="salary_info")
 
-
-
-
-
-
-
-
-
+    __table_args__ = (
+        # range scans and keyset pagination over upcoming increases
+        Index("ix_salary_info_next_salary_increase", "next_salary_increase", "salary_id"),
+        # bounds of one salary stats bucket, see SALARY_STATS_DDL
+        Index("ix_salary_info_salary", "salary"),
+    )
+
+
+class SalaryStatsBucket(Base):
+    """Count, sum and bounds of the salaries in [bucket * width, (bucket + 1) * width).
+
+    Kept up to date by the ``salary_stats_apply`` trigger on salary_info, see SALARY_STATS_DDL.
+    """
+
+    __tablename__ = "salary_stats_buckets"
+
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    count = Column(BigInteger, nullable=False)
+    total = Column(Numeric, nullable=False)
+    min_salary = Column(Numeric(14, 2), nullable=True)
+    max_salary = Column(Numeric(14, 2), nullable=True)
+
+
+class SalaryIncreaseMonth(Base):
+    """Number of ``next_salary_increase`` dates in a month, maintained by the same trigger."""
+
+    __tablename__ = "salary_increase_months"
+
+    month = Column(Date, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+
+class SalaryPercentiles(Base):
+    """Single row of salary percentiles, rewritten on a schedule and never by salary writes."""
+
+    __tablename__ = "salary_percentiles"
+
+    percentiles_id = Column(Integer, primary_key=True, default=1)
+    percentiles = Column(JSONB, nullable=False)
+    refreshed_at = Column(DateTime, nullable=False)
+
+
+SALARY_STATS_BUCKET = f"floor({{salary}} / {settings.SALARY_STATS_BUCKET_WIDTH})::bigint"
+_OLD_BUCKET = SALARY_STATS_BUCKET.format(salary="OLD.salary")
+_NEW_BUCKET = SALARY_STATS_BUCKET.format(salary="NEW.salary")
+
+# Incremental salary analytics: every salary_info row change moves one unit between
+# bucket rows, so concurrent writers only meet on the same salary bucket or month.
+# The bucket bounds are recomputed from ix_salary_info_salary only when the row
+# holding one of them goes away. Changing SALARY_STATS_BUCKET_WIDTH needs a rebuild,
+# see db/online_migrations.py.
+SALARY_STATS_DDL = [
+    f"""
+    CREATE OR REPLACE FUNCTION salary_stats_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND OLD.salary = NEW.salary
+                AND OLD.next_salary_increase = NEW.next_salary_increase THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE salary_stats_buckets SET count = count - 1, total = total - OLD.salary
+            WHERE bucket = {_OLD_BUCKET};
+            UPDATE salary_stats_buckets SET min_salary = bounds.lo, max_salary = bounds.hi
+            FROM (
+                SELECT min(salary) AS lo, max(salary) AS hi FROM salary_info
+                WHERE salary >= {_OLD_BUCKET} * {settings.SALARY_STATS_BUCKET_WIDTH}
+                AND salary < ({_OLD_BUCKET} + 1) * {settings.SALARY_STATS_BUCKET_WIDTH}
+            ) AS bounds
+            WHERE bucket = {_OLD_BUCKET}
+            AND (min_salary = OLD.salary OR max_salary = OLD.salary);
+            UPDATE salary_increase_months SET count = count - 1
+            WHERE month = date_trunc('month', OLD.next_salary_increase)::date;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO salary_stats_buckets AS b (bucket, count, total, min_salary, max_salary)
+            VALUES ({_NEW_BUCKET}, 1, NEW.salary, NEW.salary, NEW.salary)
+            ON CONFLICT (bucket) DO UPDATE SET
+                count = b.count + 1,
+                total = b.total + EXCLUDED.total,
+                min_salary = least(b.min_salary, EXCLUDED.min_salary),
+                max_salary = greatest(b.max_salary, EXCLUDED.max_salary);
+            INSERT INTO salary_increase_months AS m (month, count)
+            VALUES (date_trunc('month', NEW.next_salary_increase)::date, 1)
+            ON CONFLICT (month) DO UPDATE SET count = m.count + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS salary_stats_apply ON salary_info",
+    """
+    CREATE TRIGGER salary_stats_apply
+    AFTER INSERT OR DELETE OR UPDATE OF salary, next_salary_increase ON salary_info
+    FOR EACH ROW EXECUTE FUNCTION salary_stats_apply()
+    """,
+]
+
+for _statement in SALARY_STATS_DDL:
+    # create_all (fresh databases); migrations call db.online_migrations.create_salary_stats_triggers.
+    # Live mode never reads the counters, so its salary writes don't pay for the trigger.
+    event.listen(
+        SalaryInfo.__table__,
+        "after_create",
+        DDL(_statement).execute_if(callable_=lambda *args, **kwargs: settings.SALARY_STATS_MODE == "rollup"),
+    )
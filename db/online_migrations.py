@@ -0,0 +1,194 @@
+"""Schema changes that autogenerate can't express without locking a busy table.
+
+Call them from the ``upgrade()`` of a revision produced by
+``alembic revision --autogenerate`` in place of the generated ``op.alter_column``.
+"""
+import time
+from contextlib import contextmanager
+
+from alembic import op
+from sqlalchemy import Column, Date, Numeric, String, FLOAT, text
+from sqlalchemy.types import TypeEngine
+
+from db.models import SALARY_STATS_DDL, SALARY_STATS_BUCKET
+
+
+@contextmanager
+def _salary_stats_trigger_dropped(table: str):
+    """Drop ``salary_stats_apply`` around a change of the columns it watches, which it depends on.
+
+    It is recreated from SALARY_STATS_DDL in the same transaction, on whatever
+    columns carry the names by then, so no write goes uncounted.
+    """
+    installed = op.get_bind().execute(
+        text("SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass(:table) AND tgname = 'salary_stats_apply'"),
+        {"table": table},
+    ).first() is not None
+    if installed:
+        op.execute(f"DROP TRIGGER salary_stats_apply ON {table}")
+    yield
+    if installed:
+        for statement in SALARY_STATS_DDL:
+            op.execute(statement)
+
+
+def change_column_type_online(
+        table: str,
+        column: str,
+        new_type: TypeEngine,
+        using: str,
+        key: str,
+        index_columns: list[str] | None = None,
+        index_name: str | None = None,
+        batch_size: int = 5000,
+        backfill_retry_seconds: float = 0.1,
+) -> None:
+    """``ALTER COLUMN ... TYPE ... USING ...`` without a long ACCESS EXCLUSIVE lock.
+
+    A plain type change rewrites the table under that lock. Instead a shadow column
+    is kept in sync by a trigger, backfilled in small autocommitted batches keyed by
+    ``key`` and optionally indexed concurrently; the final swap only drops and
+    renames, so the exclusive lock is held for a moment. ``using`` is the cast
+    expression with ``{column}`` standing for the old value. The column must be NOT NULL.
+    """
+    shadow = f"{column}_new"
+    sync = f"{table}_sync_{shadow}"
+    not_null = f"{shadow}_not_null"
+
+    op.add_column(table, Column(shadow, new_type, nullable=True))
+    op.execute(f"""
+        CREATE FUNCTION {sync}() RETURNS trigger AS $$
+        BEGIN
+            NEW.{shadow} := {using.format(column=f'NEW.{column}')};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute(f"""
+        CREATE TRIGGER {sync}
+        BEFORE INSERT OR UPDATE OF {column} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {sync}()
+    """)
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        backfill = text(f"""
+            UPDATE {table} SET {shadow} = {using.format(column=column)}
+            WHERE {key} IN (
+                SELECT {key} FROM {table} WHERE {shadow} IS NULL
+                LIMIT :batch_size FOR UPDATE SKIP LOCKED
+            )
+        """)
+        remaining = text(f"SELECT 1 FROM {table} WHERE {shadow} IS NULL LIMIT 1")
+        while True:
+            while bind.execute(backfill, {"batch_size": batch_size}).rowcount:
+                pass
+            # rows skipped while a writer held them are left unfilled unless that
+            # write went through the sync trigger, come back for them once it commits
+            if bind.execute(remaining).first() is None:
+                break
+            time.sleep(backfill_retry_seconds)
+        if index_name is not None:
+            columns = ", ".join(shadow if name == column else name for name in index_columns)
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name}_new ON {table} ({columns})")
+        # validated outside the swap, so SET NOT NULL below doesn't scan the table
+        op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {not_null} CHECK ({shadow} IS NOT NULL) NOT VALID")
+        op.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {not_null}")
+
+    op.execute("SET LOCAL lock_timeout = '5s'")
+    op.execute(f"DROP TRIGGER {sync} ON {table}")
+    op.execute(f"DROP FUNCTION {sync}()")
+    with _salary_stats_trigger_dropped(table):
+        op.drop_column(table, column)
+        op.alter_column(table, shadow, new_column_name=column)
+    op.alter_column(table, column, nullable=False)
+    op.drop_constraint(not_null, table, type_="check")
+    if index_name is not None:
+        op.execute(f"ALTER INDEX {index_name}_new RENAME TO {index_name}")
+
+
+def _column_type(table: str, column: str) -> str | None:
+    return op.get_bind().execute(
+        text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"
+        ),
+        {"table": table, "column": column},
+    ).scalar()
+
+
+def convert_next_salary_increase_to_date(batch_size: int = 5000) -> None:
+    """Turn ``salary_info.next_salary_increase`` from VARCHAR into an indexed DATE."""
+    if _column_type("salary_info", "next_salary_increase") == "date":
+        return
+    change_column_type_online(
+        "salary_info",
+        "next_salary_increase",
+        Date,
+        using="{column}::date",
+        key="salary_id",
+        index_columns=["next_salary_increase", "salary_id"],
+        index_name="ix_salary_info_next_salary_increase",
+        batch_size=batch_size,
+    )
+
+
+def revert_next_salary_increase_to_string() -> None:
+    """Downgrade counterpart, a blocking rewrite is acceptable when rolling back."""
+    op.drop_index("ix_salary_info_next_salary_increase", table_name="salary_info")
+    op.alter_column(
+        "salary_info",
+        "next_salary_increase",
+        type_=String,
+        postgresql_using="to_char(next_salary_increase, 'YYYY-MM-DD')",
+    )
+
+
+def convert_salary_to_numeric(batch_size: int = 5000) -> None:
+    """Turn ``salary_info.salary`` from FLOAT into exact NUMERIC(14, 2), rounding to cents, and keep it indexed."""
+    if _column_type("salary_info", "salary") == "numeric":
+        return
+    change_column_type_online(
+        "salary_info",
+        "salary",
+        Numeric(14, 2),
+        using="round({column}::numeric, 2)",
+        key="salary_id",
+        index_columns=["salary"],
+        index_name="ix_salary_info_salary",
+        batch_size=batch_size,
+    )
+
+
+def revert_salary_to_float() -> None:
+    """Downgrade counterpart, a blocking rewrite is acceptable when rolling back."""
+    with _salary_stats_trigger_dropped("salary_info"):
+        op.alter_column("salary_info", "salary", type_=FLOAT, postgresql_using="salary::float8")
+
+
+def create_salary_stats_triggers() -> None:
+    """Install the trigger behind the salary stats rollup and fill its counters from the existing rows.
+
+    Autogenerate creates salary_stats_buckets and salary_increase_months but not
+    the trigger, call this after them, or later when switching to rollup mode. CREATE TRIGGER holds off salary writes
+    until the revision commits, so the backfill can't miss one. Run it again after
+    changing SALARY_STATS_BUCKET_WIDTH.
+    """
+    for statement in SALARY_STATS_DDL:
+        op.execute(statement)
+    op.execute("TRUNCATE salary_stats_buckets, salary_increase_months")
+    op.execute(f"""
+        INSERT INTO salary_stats_buckets (bucket, count, total, min_salary, max_salary)
+        SELECT {SALARY_STATS_BUCKET.format(salary="salary")}, count(*), sum(salary), min(salary), max(salary)
+        FROM salary_info GROUP BY 1
+    """)
+    op.execute("""
+        INSERT INTO salary_increase_months (month, count)
+        SELECT date_trunc('month', next_salary_increase)::date, count(*) FROM salary_info GROUP BY 1
+    """)
+
+
+def drop_salary_stats_triggers() -> None:
+    """Downgrade counterpart."""
+    op.execute("DROP TRIGGER IF EXISTS salary_stats_apply ON salary_info")
+    op.execute("DROP FUNCTION IF EXISTS salary_stats_apply()")
@@ -0,0 +1,52 @@
+"""Background refresh of the stored salary percentiles.
+
+Percentiles can't be maintained incrementally like the bucket counters of
+``SALARY_STATS_DDL``, so in rollup mode every worker recomputes them each
+SALARY_STATS_PERCENTILES_REFRESH_SECONDS. The refresh only reads salary_info
+and rewrites one row nobody else writes, so salary writers never wait on it.
+"""
+import asyncio
+from logging import getLogger
+
+import settings
+from db.dals import UserDAL
+from db.session import async_session
+
+logger = getLogger(__name__)
+
+
+class PercentilesRefresher:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self) -> None:
+        async with async_session() as session:
+            async with session.begin():
+                await UserDAL(session).refresh_salary_percentiles()
+
+    async def run(self) -> None:
+        """Refresh until cancelled, a failed refresh is retried on the next tick."""
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("Salary percentiles refresh failed: %s", err)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+percentiles_refresher = PercentilesRefresher(interval=settings.SALARY_STATS_PERCENTILES_REFRESH_SECONDS)
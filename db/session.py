@@ -1,19 +1,246 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import functools
+import time
+from contextlib import asynccontextmanager
+from fastapi import Request
+from fastapi.security.utils import get_authorization_scheme_param
+from prometheus_client import REGISTRY
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncConnection
 from sqlalchemy.orm import sessionmaker
-from typing import Generator
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from typing import AsyncIterator, Generator
 
 import settings
+import profiling
+from cache import TTLCache
+from metrics import POOL_WAIT_SECONDS, PoolStatsCollector, record_statement
 
 
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection."""
 
-engine = create_async_engine(settings.REAL_DATABASE_URL, future=True, echo=True)
+    checkouts = 0
+    wait_time_total = 0.0
+    wait_time_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            POOL_WAIT_SECONDS.observe(elapsed)
+            self.checkouts += 1
+            self.wait_time_total += elapsed
+            self.wait_time_max = max(self.wait_time_max, elapsed)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context.statement_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.statement_started_at
+    record_statement(elapsed)
+    profiling.record_statement(statement, elapsed)
+
+
+def create_engine_from_settings(url: str):
+    return create_async_engine(
+        url,
+        future=True,
+        echo=settings.DB_ECHO,
+        poolclass=TimedAsyncQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args={
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+        },
+    )
+
+
+engine = create_engine_from_settings(settings.REAL_DATABASE_URL)
 
 async_session = sessionmaker(engine,expire_on_commit=False, class_=AsyncSession)
 
 
+class ReplicaSet:
+    """Read replicas picked round-robin.
+
+    A replica that can't be connected to, or drops a connection, is skipped
+    for ``retry_seconds`` and the next healthy one is used instead.
+    """
+
+    def __init__(self, urls: list[str], retry_seconds: float):
+        self.engines = [create_engine_from_settings(url) for url in urls]
+        self.retry_seconds = retry_seconds
+        self._down_until = [0.0] * len(self.engines)
+        self._next = 0
+        for index, replica_engine in enumerate(self.engines):
+            event.listen(replica_engine.sync_engine, "handle_error", functools.partial(self._on_error, index))
+
+    def _on_error(self, index: int, context) -> None:
+        if context.is_disconnect:
+            self.mark_down(index)
+
+    def mark_down(self, index: int) -> None:
+        self._down_until[index] = time.monotonic() + self.retry_seconds
+
+    def healthy(self) -> list[int]:
+        """Indexes of the healthy replicas, starting with the next one in turn."""
+        count = len(self.engines)
+        start = self._next
+        self._next = (start + 1) % count
+        now = time.monotonic()
+        return [index % count for index in range(start, start + count) if self._down_until[index % count] <= now]
+
+    async def connect(self) -> AsyncConnection | None:
+        """A connection to the next healthy replica, None when every replica is down."""
+        for index in self.healthy():
+            try:
+                return await self.engines[index].connect()
+            except Exception:
+                # refused, timed out or rejected by a replica that is still starting up
+                self.mark_down(index)
+        return None
+
+    async def dispose(self) -> None:
+        for replica_engine in self.engines:
+            await replica_engine.dispose()
+
+
+replicas = (
+    ReplicaSet(settings.REPLICA_DATABASE_URLS, settings.REPLICA_RETRY_SECONDS)
+    if settings.REPLICA_DATABASE_URLS else None
+)
+
+
+# access token -> True while a write made with it may not have reached the replicas yet
+recent_writers = TTLCache(
+    maxsize=settings.REPLICA_READ_YOUR_WRITES_MAX_CLIENTS, ttl=settings.REPLICA_READ_YOUR_WRITES_SECONDS
+)
+
+
+def get_pool_stats(db_engine=engine) -> dict:
+    pool = db_engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": pool.checkouts,
+        "wait_time_total": pool.wait_time_total,
+        "wait_time_max": pool.wait_time_max,
+    }
+
+
+REGISTRY.register(PoolStatsCollector(get_pool_stats))
+
+
+@asynccontextmanager
+async def unit_of_work(db: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """Run a whole request handler in one transaction on ``db``.
+
+    Every ``transaction`` block inside joins it, so the handler uses one
+    connection and commits once. The auth lookup runs and commits before the
+    handler, outside of it. A no-op when ``DB_UNIT_OF_WORK`` is disabled.
+    """
+    if not settings.DB_UNIT_OF_WORK or in_unit_of_work(db):
+        yield db
+        return
+    db.info["unit_of_work"] = True
+    try:
+        if not db.in_transaction():
+            await db.begin()
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+    finally:
+        db.info.pop("unit_of_work", None)
+
+
+@asynccontextmanager
+async def transaction(db: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """Transaction for a single action helper.
+
+    Joins the request's unit of work, or runs as one on its own when called
+    outside of it. With ``DB_UNIT_OF_WORK`` disabled it opens a fresh session
+    transaction every time.
+    """
+    if settings.DB_UNIT_OF_WORK:
+        async with unit_of_work(db) as session:
+            yield session
+        return
+    async with db as session:
+        async with session.begin():
+            yield session
+
+
+def in_unit_of_work(db: AsyncSession) -> bool:
+    return db.info.get("unit_of_work", False)
+
+
+def is_replica(db: AsyncSession) -> bool:
+    """Whether ``db`` is a ``get_read_db`` session on a replica, which may lag behind the primary."""
+    return db.info.get("replica", False)
+
+
+def set_writer(db: AsyncSession, token: str) -> None:
+    """Attribute what ``db`` commits to the client holding ``token``, see ``note_write``."""
+    db.info["writer"] = token
+
+
+def note_write(session) -> None:
+    """Send the reads of the client that committed ``session`` to the primary for a while."""
+    writer = session.info.get("writer")
+    if writer is not None and replicas is not None:
+        recent_writers.set(writer, True, ttl=settings.REPLICA_READ_YOUR_WRITES_SECONDS)
+
+
 async def get_db() -> Generator:
     try:
         session: AsyncSession = async_session()
         yield session
     finally:
-        await session.close()
\ No newline at end of file
+        await session.close()
+
+
+async def get_read_db(request: Request) -> Generator:
+    """Session for read-only handlers.
+
+    Uses a replica when any is configured and healthy, otherwise a session on
+    the primary; only one of them is opened. A client that wrote within
+    REPLICA_READ_YOUR_WRITES_SECONDS reads from the primary, replicas may not
+    have its write yet. Handlers that write use ``get_db``, and so does the auth
+    lookup: it fills caches that only writes invalidate, a lagging replica would
+    keep revoked rights there.
+    """
+    connection = None
+    if replicas is not None:
+        _, token = get_authorization_scheme_param(request.headers.get("Authorization"))
+        if recent_writers.get(token) is None:
+            connection = await replicas.connect()
+    if connection is None:
+        session = async_session()
+        try:
+            yield session
+        finally:
+            await session.close()
+        return
+    session = AsyncSession(bind=connection, expire_on_commit=False)
+    session.info["replica"] = True
+    try:
+        yield session
+    finally:
+        await session.close()
+        await connection.close()
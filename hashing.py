@@ -1,8 +1,75 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
 from passlib.context import CryptContext
+from prometheus_client import REGISTRY
+
+import settings
+from metrics import HASHING_SECONDS, HashingPoolCollector, timed
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
+class HashingPool:
+    """Runs CPU-bound hashing on a worker pool instead of the event loop.
+
+    At most ``max_concurrency`` jobs are handed to the executor at a time,
+    the rest wait on a semaphore and are reported as ``queue_depth``.
+    """
+
+    def __init__(self, executor_factory: Callable[[], Executor], max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.queue_depth = 0
+        self.running = 0
+        self._executor_factory = executor_factory
+        self._executor: Executor | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio primitives are bound to the loop they were first used on
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._executor is None:
+            self._executor = self._executor_factory()
+        self.queue_depth += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+        self.running += 1
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _create_executor() -> Executor:
+    if settings.HASHING_EXECUTOR == "process":
+        return ProcessPoolExecutor(max_workers=settings.HASHING_WORKERS)
+    return ThreadPoolExecutor(max_workers=settings.HASHING_WORKERS, thread_name_prefix="hashing")
+
+
+hashing_pool = HashingPool(_create_executor, max_concurrency=settings.HASHING_MAX_CONCURRENCY)
+REGISTRY.register(HashingPoolCollector(hashing_pool.stats))
+
+
 class Hasher:
     @staticmethod
     def verify_password(plain_password, hashed_password):
@@ -10,4 +77,16 @@ class Hasher:
 
     @staticmethod
     def get_password_hash(password):
-        return pwd_context.hash(password)
\ No newline at end of file
+        return pwd_context.hash(password)
+
+    @staticmethod
+    async def verify_password_async(plain_password, hashed_password):
+        result, elapsed = await hashing_pool.run(timed, Hasher.verify_password, plain_password, hashed_password)
+        HASHING_SECONDS.labels("verify").observe(elapsed)
+        return result
+
+    @staticmethod
+    async def get_password_hash_async(password):
+        result, elapsed = await hashing_pool.run(timed, Hasher.get_password_hash, password)
+        HASHING_SECONDS.labels("hash").observe(elapsed)
+        return result
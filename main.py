@@ -1,11 +1,23 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+import sentry_sdk
 import uvicorn
 from fastapi.routing import APIRouter
+from starlette_exporter import PrometheusMiddleware, handle_metrics
+
+import settings
 from api.routers.user_router import user_router
 from api.routers.login_router import login_router
+from db.invalidation_bus import bus
+from db.salary_stats import percentiles_refresher
+from hashing import hashing_pool
+from metrics import RequestDBMetricsMiddleware
+from profiling import SQLProfilerMiddleware
 
+if settings.SENTRY_DSN:
+    sentry_sdk.init(dsn=settings.SENTRY_DSN, traces_sample_rate=settings.SENTRY_TRACES_SAMPLE_RATE)
 
-app = FastAPI(title="shift_task")
+app = FastAPI(title="shift_task", default_response_class=ORJSONResponse)
 
 main_api_router = APIRouter()
 
@@ -14,5 +26,45 @@ main_api_router.include_router(login_router, prefix="/login", tags=["tags"])
 
 app.include_router(main_api_router)
 
+# per-route request count and latency histograms, labelled with the route template
+app.add_middleware(
+    PrometheusMiddleware,
+    app_name="salary_api",
+    group_paths=True,
+    filter_unhandled_paths=True,
+    skip_paths=["/metrics"],
+)
+app.add_middleware(RequestDBMetricsMiddleware)
+app.add_middleware(SQLProfilerMiddleware)
+app.add_route("/metrics", handle_metrics)
+
+
+@app.on_event("shutdown")
+def shutdown_hashing_pool():
+    hashing_pool.shutdown()
+
+
+@app.on_event("startup")
+def start_invalidation_bus():
+    if settings.INVALIDATION_BUS_ENABLED:
+        bus.start()
+
+
+@app.on_event("shutdown")
+async def stop_invalidation_bus():
+    await bus.stop()
+
+
+@app.on_event("startup")
+def start_salary_percentiles_refresh():
+    if settings.SALARY_STATS_MODE == "rollup":
+        percentiles_refresher.start()
+
+
+@app.on_event("shutdown")
+async def stop_salary_percentiles_refresh():
+    await percentiles_refresher.stop()
+
+
 if __name__ == "__main__":
     uvicorn.run(app, port=8003)
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""Prometheus metrics exposed on ``/metrics``.
+
+Per-route request latency comes from starlette_exporter. On top of it every
+request records how many SQL statements it ran and how long it waited on the
+database, so a slow route can be told apart from a slow query or a pool that
+is too small. Hashing, connection pool waits and in-process caches are
+reported separately.
+"""
+import time
+from contextvars import ContextVar
+from typing import Callable
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50, 100)
+
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements",
+    "SQL statements executed per request.",
+    ["method", "path"],
+    buckets=STATEMENTS_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Time spent executing SQL statements per request.",
+    ["method", "path"],
+)
+DB_STATEMENTS = Counter("db_statements", "SQL statements executed.")
+DB_STATEMENT_SECONDS = Histogram("db_statement_seconds", "Duration of a single SQL statement.")
+HASHING_SECONDS = Histogram(
+    "password_hashing_seconds",
+    "Time bcrypt spends in a worker per operation, without the wait for a free worker.",
+    ["operation"],
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls",
+    "Read helper calls that ran their own query (executed) or shared one already in flight (coalesced).",
+    ["helper", "outcome"],
+)
+ENTITY_CACHE_LOOKUPS = Counter(
+    "entity_cache_lookups",
+    "Read-through entity cache lookups per read helper, the hit rate is hit / (hit + miss).",
+    ["helper", "result"],
+)
+INVALIDATION_BUS_MESSAGES = Counter(
+    "invalidation_bus_messages",
+    "Invalidation notifications received, own ones are skipped.",
+    ["result"],
+)
+INVALIDATION_BUS_FLUSHES = Counter(
+    "invalidation_bus_flushes",
+    "Full cache flushes after a (re)connect of the listener or a lost notification.",
+    ["reason"],
+)
+POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time a checkout waited for a pooled connection.")
+
+
+class RequestDBStats:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+_request_db_stats: ContextVar[RequestDBStats | None] = ContextVar("request_db_stats", default=None)
+
+
+def record_statement(seconds: float) -> None:
+    """Account one executed SQL statement to the running request, if any."""
+    DB_STATEMENTS.inc()
+    DB_STATEMENT_SECONDS.observe(seconds)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.seconds += seconds
+
+
+def route_path(scope: Scope) -> str | None:
+    """Path template of the route that handled ``scope``, None for unhandled paths."""
+    router = scope.get("router")
+    if router is None:
+        return None
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return None
+
+
+class RequestDBMetricsMiddleware:
+    """Observes SQL statement count and DB time of every routed request."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestDBStats()
+        token = _request_db_stats.set(stats)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_db_stats.reset(token)
+            path = route_path(scope)
+            if path is not None:
+                REQUEST_DB_STATEMENTS.labels(scope["method"], path).observe(stats.statements)
+                REQUEST_DB_SECONDS.labels(scope["method"], path).observe(stats.seconds)
+
+
+def timed(func: Callable, *args):
+    """Run ``func`` and return its result with the elapsed time, picklable for process pools."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class PoolStatsCollector:
+    """Exports ``get_pool_stats`` of an engine at scrape time."""
+
+    def __init__(self, get_stats: Callable[[], dict]):
+        self._get_stats = get_stats
+
+    def collect(self):
+        stats = self._get_stats()
+        for name in ("size", "checked_in", "checked_out", "overflow"):
+            yield GaugeMetricFamily(f"db_pool_{name}", f"Connection pool {name.replace('_', ' ')}.", stats[name])
+        yield CounterMetricFamily("db_pool_checkouts", "Connection pool checkouts.", stats["checkouts"])
+        yield CounterMetricFamily(
+            "db_pool_wait_time_seconds", "Total time checkouts waited for a connection.", stats["wait_time_total"]
+        )
+        yield GaugeMetricFamily(
+            "db_pool_wait_time_max_seconds", "Longest time a checkout waited for a connection.", stats["wait_time_max"]
+        )
+
+
+class CacheStatsCollector:
+    """Exports ``TTLCache.stats`` of named caches at scrape time."""
+
+    def __init__(self, caches: dict[str, Callable[[], dict]]):
+        self._caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "In-process cache hits.", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "In-process cache misses, expired entries too.", labels=["cache"])
+        size = GaugeMetricFamily("cache_size", "Entries held by an in-process cache.", labels=["cache"])
+        maxsize = GaugeMetricFamily("cache_maxsize", "Entry limit of an in-process cache.", labels=["cache"])
+        for name, get_stats in self._caches.items():
+            stats = get_stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+            maxsize.add_metric([name], stats["maxsize"])
+        yield from (hits, misses, size, maxsize)
+
+
+class HashingPoolCollector:
+    """Exports ``HashingPool.stats`` at scrape time."""
+
+    def __init__(self, get_stats: Callable[[], dict]):
+        self._get_stats = get_stats
+
+    def collect(self):
+        stats = self._get_stats()
+        yield GaugeMetricFamily(
+            "password_hashing_max_concurrency", "Hashing jobs handed to the worker pool at once.",
+            stats["max_concurrency"],
+        )
+        yield GaugeMetricFamily("password_hashing_running", "Hashing jobs running in a worker.", stats["running"])
+        yield GaugeMetricFamily(
+            "password_hashing_queue_depth", "Hashing jobs waiting for a free slot.", stats["queue_depth"]
+        )
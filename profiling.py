@@ -0,0 +1,113 @@
+"""Per-request SQL profiler for debugging round-trips, enabled by SQL_PROFILER.
+
+Every statement a request executes is recorded with its text, duration and the
+``UserDAL`` method that issued it. The response carries a summary in
+``X-SQL-Query-Count``, ``X-SQL-Time-Ms`` and ``X-SQL-Profile`` headers, and the
+whole profile is logged once the request is done. Statements run after the
+response has started (streaming bodies) are only in the log line.
+"""
+import functools
+import inspect
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from logging import getLogger
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import settings
+
+logger = getLogger(__name__)
+
+UNATTRIBUTED = "-"
+
+
+@dataclass(frozen=True)
+class ProfiledStatement:
+    statement: str
+    seconds: float
+    dal_method: str
+
+
+@dataclass
+class SQLProfile:
+    statements: list[ProfiledStatement] = field(default_factory=list)
+
+    @property
+    def seconds(self) -> float:
+        return sum(statement.seconds for statement in self.statements)
+
+    def summary(self) -> str:
+        """Statement count and DB time per issuing DAL method, in order of first use."""
+        counts = Counter(statement.dal_method for statement in self.statements)
+        seconds = Counter()
+        for statement in self.statements:
+            seconds[statement.dal_method] += statement.seconds
+        return ", ".join(f"{method} x{count} {seconds[method] * 1000:.1f}ms" for method, count in counts.items())
+
+
+_current_profile: ContextVar[SQLProfile | None] = ContextVar("sql_profile", default=None)
+_current_dal_method: ContextVar[str] = ContextVar("dal_method", default=UNATTRIBUTED)
+
+
+def record_statement(statement: str, seconds: float) -> None:
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.statements.append(ProfiledStatement(statement, seconds, _current_dal_method.get()))
+
+
+def attribute_statements(cls):
+    """Class decorator tagging the statements of every coroutine method with ``Class.method``.
+
+    Outside a profiled request the wrapper only adds a call, there is no profile to tag.
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith("__") or not inspect.iscoroutinefunction(method):
+            continue
+
+        def wrap(method, label):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                if _current_profile.get() is None:
+                    return await method(*args, **kwargs)
+                token = _current_dal_method.set(label)
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    _current_dal_method.reset(token)
+            return wrapper
+
+        setattr(cls, name, wrap(method, f"{cls.__name__}.{name}"))
+    return cls
+
+
+class SQLProfilerMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not settings.SQL_PROFILER:
+            await self.app(scope, receive, send)
+            return
+        profile = SQLProfile()
+        token = _current_profile.set(profile)
+
+        async def send_with_summary(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-SQL-Query-Count"] = str(len(profile.statements))
+                headers["X-SQL-Time-Ms"] = f"{profile.seconds * 1000:.3f}"
+                headers["X-SQL-Profile"] = profile.summary()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_summary)
+        finally:
+            _current_profile.reset(token)
+            logger.info(
+                "%s %s: %d SQL statements in %.1fms (%s)",
+                scope["method"], scope["path"], len(profile.statements), profile.seconds * 1000, profile.summary(),
+            )
+            for statement in profile.statements:
+                logger.debug("%.3fms %s: %s", statement.seconds * 1000, statement.dal_method, statement.statement)
@@ -0,0 +1,105 @@
+"""Sliding-window rate limiting, used to throttle logins before any bcrypt work."""
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Hashable
+
+
+class RateLimitBackend(ABC):
+    """Storage of sliding-window counters, shared stores (e.g. Redis) implement the same calls."""
+
+    @abstractmethod
+    async def retry_after(self, key: Hashable, limit: int, window: float) -> float:
+        """Seconds until ``key`` may make another attempt within ``limit`` per ``window`` seconds, 0 if it may now.
+
+        Nothing is counted.
+        """
+
+    @abstractmethod
+    async def hit(self, key: Hashable, limit: int, window: float) -> float:
+        """Count one attempt for ``key``.
+
+        Returns 0 when it is within ``limit`` attempts per ``window`` seconds,
+        otherwise the seconds until the next attempt would be allowed. Rejected
+        attempts are not counted.
+        """
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Per-process sliding-window counters, O(1) per hit.
+
+    Each key keeps the counts of the current and the previous fixed window, the
+    previous one is weighted by how much of it still overlaps the sliding window.
+    Keys are kept in LRU order and the least recently used ones are evicted
+    beyond ``maxsize``, so a flood of distinct logins can't grow memory.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # key -> [window number, count in the current window, count in the previous window]
+        self._counters: OrderedDict[Hashable, list] = OrderedDict()
+
+    def _counter(self, key: Hashable, window: float, create: bool) -> tuple[list | None, float]:
+        """Counter of ``key`` rolled over to the current window, and the seconds elapsed in it."""
+        now = time.monotonic()
+        current = int(now // window)
+        elapsed = now - current * window
+        counter = self._counters.get(key)
+        if counter is None:
+            if not create:
+                return None, elapsed
+            counter = self._counters[key] = [current, 0, 0]
+            while len(self._counters) > self.maxsize:
+                self._counters.popitem(last=False)
+        else:
+            self._counters.move_to_end(key)
+            if counter[0] != current:
+                counter[2] = counter[1] if counter[0] == current - 1 else 0
+                counter[0], counter[1] = current, 0
+        return counter, elapsed
+
+    @staticmethod
+    def _wait(counter: list, elapsed: float, limit: int, window: float) -> float:
+        if counter[2] * (1 - elapsed / window) + counter[1] < limit:
+            return 0.0
+        if counter[1] >= limit or not counter[2]:
+            return window - elapsed
+        # the previous window's weight drops low enough before the current window ends
+        return max(0.0, (1 - (limit - counter[1]) / counter[2]) * window - elapsed)
+
+    async def retry_after(self, key: Hashable, limit: int, window: float) -> float:
+        counter, elapsed = self._counter(key, window, create=False)
+        if counter is None:
+            return 0.0 if limit > 0 else window - elapsed
+        return self._wait(counter, elapsed, limit, window)
+
+    async def hit(self, key: Hashable, limit: int, window: float) -> float:
+        counter, elapsed = self._counter(key, window, create=True)
+        wait = self._wait(counter, elapsed, limit, window)
+        if not wait:
+            counter[1] += 1
+        return wait
+
+    def clear(self) -> None:
+        self._counters.clear()
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend):
+        self.backend = backend
+
+    async def check(self, limits: list[tuple[Hashable, int, float]]) -> int:
+        """Seconds to wait before retrying, rounded up, 0 when every ``(key, limit, window)`` allows the attempt.
+
+        An attempt is counted against its keys only when all of them allow it, so
+        e.g. attempts rejected by a per-IP limit don't use up the per-login one.
+        """
+        retry_after = max(
+            [await self.backend.retry_after(key, limit, window) for key, limit, window in limits], default=0.0
+        )
+        if retry_after:
+            return math.ceil(retry_after)
+        for key, limit, window in limits:
+            retry_after = max(retry_after, await self.backend.hit(key, limit, window))
+        return math.ceil(retry_after)
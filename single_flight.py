@@ -0,0 +1,51 @@
+"""Request coalescing for read helpers.
+
+Concurrent calls of a helper with the same key share the first caller's query
+and its result instead of each running their own. Only calls outside a unit of
+work are coalesced: inside one the caller may read its own uncommitted writes.
+"""
+import asyncio
+import functools
+from typing import Awaitable, Callable, Hashable
+
+from db.session import in_unit_of_work
+from metrics import SINGLE_FLIGHT_CALLS
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is None:
+            SINGLE_FLIGHT_CALLS.labels(self.name, "executed").inc()
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+            # the query runs on the caller's session, so it is cancelled together with the caller
+            return await task
+        SINGLE_FLIGHT_CALLS.labels(self.name, "coalesced").inc()
+        await asyncio.wait({task})
+        if task.cancelled():
+            return await func()
+        return task.result()
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+def coalesce(name: str):
+    """Decorator for ``helper(key, db)`` read helpers, see the module docstring."""
+    flight = SingleFlight(name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(key, db):
+            if in_unit_of_work(db):
+                return await func(key, db)
+            return await flight.do(key, lambda: func(key, db))
+        return wrapper
+    return decorator
@@ -1,6 +1,11 @@
 import json
+from decimal import Decimal
+from uuid import uuid4
+
 import pytest
 
+import settings
+from db.models import PortalRole
 from tests.conftest import create_user_auth_headers_for_user
 
 
@@ -77,7 +82,157 @@ async def test_create_salary_info(client, get_user_from_database, get_salary_inf
 
     assert len(salary_infos_from_db) == 1
     salary_info_from_db = dict(salary_infos_from_db[0])
-    assert salary_info_from_db["salary"] == str(salary_info["salary"])
-    assert salary_info_from_db["next_salary_increase"] == salary_info["next_salary_increase"]
+    assert salary_info_from_db["salary"] == Decimal(salary_info["salary"])
+    assert salary_info_from_db["next_salary_increase"].isoformat() == salary_info["next_salary_increase"]
     assert str(salary_info_from_db["user_id"]) == salary_info["user_id"]
     assert str(salary_info_from_db["salary_id"]) == data_from_resp["salary_id"]
+
+
+@pytest.mark.asyncio
+async def test_create_users_bulk(client, create_user_in_database, get_user_from_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    users_data = [
+        {"login": "test1", "name": "bulkone", "surname": "bulk", "email": "bulk1@gmail.com", "password": "pass"},
+        {"login": "admin", "name": "bulktwo", "surname": "bulk", "email": "bulk2@gmail.com", "password": "pass"},
+        {"login": "test3", "name": "bulk3", "surname": "bulk", "email": "bulk3@gmail.com", "password": "pass"},
+        {"login": "test4", "name": "bulkfour", "surname": "bulk", "email": "bulk1@gmail.com", "password": "pass"},
+    ]
+    resp = client.post(
+        "/user/bulk", data=json.dumps(users_data),
+        headers=create_user_auth_headers_for_user(admin_data["login"]),
+    )
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["created"] == 1
+    assert data_from_resp["failed"] == 3
+    results = data_from_resp["results"]
+    assert [result["index"] for result in results] == [0, 1, 2, 3]
+    assert results[0]["error"] is None
+    assert results[1]["error"] == "User with this login already exists"
+    assert results[2]["error"] == "name: Name should contains only letters"
+    assert results[3]["error"] == "Duplicate login or email in request"
+    users_from_db = await get_user_from_database(results[0]["user_id"])
+    assert len(users_from_db) == 1
+    assert dict(users_from_db[0])["login"] == "test1"
+
+
+@pytest.mark.asyncio
+async def test_create_users_bulk_ndjson(client, create_user_in_database, get_user_from_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    users_data = [
+        {"login": f"test{i}", "name": "bulk", "surname": "bulk", "email": f"bulk{i}@gmail.com", "password": "pass"}
+        for i in range(3)
+    ]
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    headers["Content-Type"] = "application/x-ndjson"
+    resp = client.post(
+        "/user/bulk", data="\n".join(json.dumps(user_data) for user_data in users_data) + "\nnot json\n",
+        headers=headers,
+    )
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["created"] == 3
+    assert data_from_resp["failed"] == 1
+    for result in data_from_resp["results"][:3]:
+        assert len(await get_user_from_database(result["user_id"])) == 1
+
+
+@pytest.mark.asyncio
+async def test_create_users_bulk_stops_reading_at_max_rows(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "BULK_MAX_ROWS", 2)
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    users_data = [
+        {"login": f"test{i}", "name": "bulk", "surname": "bulk", "email": f"bulk{i}@gmail.com", "password": "pass"}
+        for i in range(5)
+    ]
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    headers["Content-Type"] = "application/x-ndjson"
+    resp = client.post(
+        "/user/bulk", data="\n".join(json.dumps(user_data) for user_data in users_data), headers=headers
+    )
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["created"] == 2
+    assert data_from_resp["failed"] == 1
+    assert data_from_resp["results"][2]["index"] == 2
+    assert data_from_resp["results"][2]["error"].startswith("Bulk limit of 2 records exceeded")
+
+
+@pytest.mark.asyncio
+async def test_create_users_bulk_reports_every_invalid_field(client, create_user_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    users_data = [{"name": "bulk1", "surname": "bulk2", "email": "bulk"}]
+    resp = client.post(
+        "/user/bulk", data=json.dumps(users_data),
+        headers=create_user_auth_headers_for_user(admin_data["login"]),
+    )
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["failed"] == 1
+    assert data_from_resp["results"][0]["error"] == "; ".join([
+        "login: field required",
+        "name: Name should contains only letters",
+        "surname: Surname should contains only letters",
+        "email: value is not a valid email address",
+        "password: field required",
+    ])
+
+
+@pytest.mark.asyncio
+async def test_create_users_bulk_by_user_forbidden(client, create_user_in_database):
+    user_data = {
+        "user_id": uuid4(),
+        "login": "test1",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    resp = client.post(
+        "/user/bulk", data=json.dumps([]),
+        headers=create_user_auth_headers_for_user(user_data["login"]),
+    )
+    assert resp.status_code == 403
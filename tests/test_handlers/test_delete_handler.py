@@ -167,5 +167,44 @@ async def test_delete_another_user_error(client, create_user_in_database, get_us
     assert resp.status_code == 403
 
 
-
-
+@pytest.mark.asyncio
+async def test_delete_salary_info(
+        client, create_user_in_database, create_salary_info_in_database, get_salary_info_from_database
+):
+    user_data = {
+        "user_id": uuid4(),
+        "login": "test1",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    other_user_data = {
+        "user_id": uuid4(),
+        "login": "test2",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser2@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    salary_id = uuid4()
+    await create_user_in_database(**user_data)
+    await create_user_in_database(**other_user_data)
+    await create_salary_info_in_database(salary_id, 300.0, "2022-12-12", user_data["user_id"])
+    resp = client.delete(
+        f"/user/salary?salary_id={salary_id}",
+        headers=create_user_auth_headers_for_user(other_user_data["login"]),
+    )
+    assert resp.status_code == 403
+    assert len(await get_salary_info_from_database(salary_id)) == 1
+    resp = client.delete(
+        f"/user/salary?salary_id={salary_id}",
+        headers=create_user_auth_headers_for_user(user_data["login"]),
+    )
+    assert resp.status_code == 200
+    assert resp.json() == {"deleted_salary_id": str(salary_id)}
+    assert len(await get_salary_info_from_database(salary_id)) == 0
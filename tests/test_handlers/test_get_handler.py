@@ -1,9 +1,19 @@
+import asyncio
+import json
+from datetime import date, timedelta
 from uuid import uuid4
 
 import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import insert, update
 
+import settings
+from api.actions.user import _get_user_by_id
 from db.dals import PortalRole
-from tests.conftest import create_user_auth_headers_for_user
+from db.entity_cache import user_cache
+from db.models import User
+from db.session import recent_writers
+from tests.conftest import create_user_auth_headers_for_user, assert_max_queries
 
 
 @pytest.mark.asyncio
@@ -30,3 +40,477 @@ async def test_get_user_by_id(client, create_user_in_database, get_user_from_dat
     assert user_from_response["email"] == user_data["email"]
     assert user_from_response["is_active"] is True
     assert user_from_response["user_id"] == str(user_data["user_id"])
+
+
+@pytest.mark.asyncio
+async def test_fast_read_responses_match_models(
+        client, create_user_in_database, create_salary_info_in_database, monkeypatch,
+):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "testfastread",
+        "surname": "testfastread",
+        "email": "testfastread@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    await create_salary_info_in_database(uuid4(), 1234.5, "2023-03-01", user_data["user_id"])
+    headers = create_user_auth_headers_for_user(user_data["login"])
+
+    responses = {}
+    for fast in (False, True):
+        monkeypatch.setattr(settings, "FAST_READ_RESPONSES", fast)
+        user_resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+        salary_resp = client.get("/user/salary", headers=headers)
+        assert user_resp.status_code == salary_resp.status_code == 200
+        responses[fast] = (user_resp.json(), salary_resp.json())
+    assert responses[True] == responses[False]
+    assert responses[True][1]["salary"] == 1234.5
+
+    resp = client.get(f"/user/?user_id={uuid4()}", headers=headers)
+    assert resp.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_list_users_keyset_pagination(client, create_user_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    for i in range(4):
+        await create_user_in_database(
+            user_id=uuid4(), name=f"listed{'ab'[i % 2]}", surname="listed", email=f"listed{i}@gmail.com",
+            is_active=i != 3, hashed_password="hashed_pass", login=f"listed{i}", roles=[PortalRole.ROLE_PORTAL_USER],
+        )
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    seen_user_ids = []
+    cursor = None
+    while True:
+        url = "/user/list?limit=2&name_prefix=listed"
+        if cursor is not None:
+            url += f"&cursor={cursor}"
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        page = resp.json()
+        seen_user_ids.extend(user["user_id"] for user in page["users"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(seen_user_ids) == 4
+    assert seen_user_ids == sorted(seen_user_ids)
+
+    resp = client.get("/user/list?is_active=true&name_prefix=listeda", headers=headers)
+    assert [user["name"] for user in resp.json()["users"]] == ["listeda", "listeda"]
+
+    resp = client.get("/user/list?role=ROLE_PORTAL_ADMIN", headers=headers)
+    assert [user["user_id"] for user in resp.json()["users"]] == [str(admin_data["user_id"])]
+
+
+@pytest.mark.asyncio
+async def test_list_users_by_user_forbidden(client, create_user_in_database):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "testlistusers",
+        "surname": "testlistusers",
+        "email": "testlistusers@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    resp = client.get("/user/list", headers=create_user_auth_headers_for_user(user_data["login"]))
+    assert resp.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_export_salary_infos(client, create_user_in_database, create_salary_info_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    other_admin_data = {
+        "user_id": uuid4(),
+        "name": "otheradmin",
+        "surname": "otheradmin",
+        "email": "otheradmin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "otheradmin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    user_data = {
+        "user_id": uuid4(),
+        "name": "testexport",
+        "surname": "testexport",
+        "email": "testexport@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    for data in (admin_data, other_admin_data, user_data):
+        await create_user_in_database(**data)
+        await create_salary_info_in_database(uuid4(), 300.0, "2022-12-12", data["user_id"])
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+
+    resp = client.get("/user/salary/export", headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+    lines = resp.text.strip().splitlines()
+    assert lines[0] == "salary_id,user_id,login,name,surname,email,salary,next_salary_increase"
+    assert sorted(line.split(",")[2] for line in lines[1:]) == ["admin", "test1"]
+
+    resp = client.get("/user/salary/export?format=ndjson", headers=headers)
+    assert resp.status_code == 200
+    rows = [json.loads(line) for line in resp.text.strip().splitlines()]
+    assert sorted(row["login"] for row in rows) == ["admin", "test1"]
+
+    resp = client.get("/user/salary/export", headers=create_user_auth_headers_for_user(user_data["login"]))
+    assert resp.status_code == 403
+
+
+@pytest.mark.parametrize("stats_mode", ["live", "rollup"])
+@pytest.mark.asyncio
+async def test_get_salary_stats(client, create_user_in_database, create_salary_info_in_database, monkeypatch,
+                                stats_mode):
+    monkeypatch.setattr(settings, "SALARY_STATS_MODE", stats_mode)
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_SUPERUSER],
+    }
+    await create_user_in_database(**admin_data)
+    next_increase = (date.today() + timedelta(days=40)).isoformat()
+    salary_ids = []
+    for i, salary in enumerate([100.0, 200.0, 300.0]):
+        user_id = uuid4()
+        await create_user_in_database(
+            user_id=user_id, name="stats", surname="stats", email=f"stats{i}@gmail.com", is_active=True,
+            hashed_password="hashed_pass", login=f"stats{i}", roles=[PortalRole.ROLE_PORTAL_USER],
+        )
+        salary_ids.append(uuid4())
+        await create_salary_info_in_database(salary_ids[-1], salary, next_increase, user_id)
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+
+    resp = client.get("/user/salary/stats", headers=headers)
+    assert resp.status_code == 200
+    stats = resp.json()
+    assert stats["mode"] == stats_mode
+    assert stats["count"] == 3
+    assert stats["mean"] == 200
+    assert stats["percentiles"]["p50"] == 200
+    assert sum(bucket["count"] for bucket in stats["histogram"]) == 3
+    assert stats["upcoming_increases"] == [{"month": next_increase[:7], "count": 3}]
+
+    resp = client.patch(f"/user/salary?salary_id={salary_ids[0]}", data=json.dumps({"salary": 400}), headers=headers)
+    assert resp.status_code == 200
+    resp = client.get("/user/salary/stats", headers=headers)
+    stats = resp.json()
+    assert stats["mean"] == 300
+    # 100 was the lowest salary of its bucket, the rollup recomputes the bound
+    assert stats["min"] == 200
+    assert stats["max"] == 400
+    assert stats["percentiles"]["p50"] == 300
+
+
+@pytest.mark.asyncio
+async def test_list_salary_increases_due(client, create_user_in_database, create_salary_info_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_SUPERUSER],
+    }
+    await create_user_in_database(**admin_data)
+    for i, next_increase in enumerate(["2023-01-15", "2023-02-01", "2023-02-01", "2023-05-01"]):
+        user_id = uuid4()
+        await create_user_in_database(
+            user_id=user_id, name="raise", surname="raise", email=f"raise{i}@gmail.com", is_active=True,
+            hashed_password="hashed_pass", login=f"raise{i}", roles=[PortalRole.ROLE_PORTAL_USER],
+        )
+        await create_salary_info_in_database(uuid4(), 100.0, next_increase, user_id)
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+
+    seen, cursor = [], None
+    while True:
+        url = "/user/salary/increases?date_from=2023-01-01&date_to=2023-03-31&limit=2"
+        resp = client.get(url + (f"&cursor={cursor}" if cursor else ""), headers=headers)
+        assert resp.status_code == 200
+        page = resp.json()
+        seen.extend(salary_info["next_salary_increase"] for salary_info in page["salary_infos"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == ["2023-01-15", "2023-02-01", "2023-02-01"]
+
+    resp = client.get("/user/salary/increases?date_from=2023-03-31&date_to=2023-01-01", headers=headers)
+    assert resp.status_code == 422
+    resp = client.get(
+        "/user/salary/increases?date_from=2023-01-01&date_to=2023-03-31",
+        headers=create_user_auth_headers_for_user("raise0"),
+    )
+    assert resp.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_metrics_report_route_latency_and_db_statements(client, create_user_in_database):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "testmetrics",
+        "surname": "testmetrics",
+        "email": "testmetrics@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    resp = client.get(
+        f"/user/?user_id={user_data['user_id']}",
+        headers=create_user_auth_headers_for_user(user_data["login"]),
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    samples = {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in resp.text.splitlines() if line and not line.startswith("#")
+    }
+    assert samples['starlette_request_duration_seconds_count{app_name="salary_api",method="GET",path="/user/",status_code="200"}'] >= 1
+    assert samples['http_request_db_statements_sum{method="GET",path="/user/"}'] >= 2
+    assert "db_pool_wait_time_seconds_total" in samples
+    assert samples['cache_misses_total{cache="principal"}'] >= 1
+    assert samples["password_hashing_max_concurrency"] == settings.HASHING_MAX_CONCURRENCY
+    assert samples["password_hashing_queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reads_are_routed_to_a_healthy_replica(
+        client, create_user_in_database, get_user_from_database, replica_engine,
+):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "Primary",
+        "surname": "Primary",
+        "email": "replica@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    # the replica instance doesn't replicate, a different name tells where a read went
+    async with replica_engine.begin() as connection:
+        await connection.execute(insert(User).values(**{**user_data, "name": "Replica"}))
+    headers = create_user_auth_headers_for_user(user_data["login"])
+
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Replica"
+
+    resp = client.patch(
+        f"/user/?user_id={user_data['user_id']}", data=json.dumps({"surname": "Renamed"}), headers=headers
+    )
+    assert resp.status_code == 200
+    users_from_db = await get_user_from_database(user_data["user_id"])
+    assert dict(users_from_db[0])["surname"] == "Renamed"
+    # the writer reads its own write from the primary
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.json()["surname"] == "Renamed"
+    # the window and the entry cached from the primary are over, the lagging replica serves the read again
+    recent_writers.clear()
+    user_cache.clear()
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.json()["surname"] == "Primary"
+    # once the replica catches up the stale row isn't served from the cache
+    async with replica_engine.begin() as connection:
+        await connection.execute(update(User).where(User.user_id == user_data["user_id"]).values(surname="Renamed"))
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.json()["surname"] == "Renamed"
+
+
+@pytest.mark.asyncio
+async def test_auth_lookup_is_not_served_by_a_lagging_replica(client, create_user_in_database, replica_engine):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "Demoted",
+        "surname": "Demoted",
+        "email": "demoted@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "demoted",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    # the replica hasn't caught up with the demotion yet
+    async with replica_engine.begin() as connection:
+        await connection.execute(insert(User).values(
+            **{**user_data, "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN]}
+        ))
+
+    resp = client.get("/user/salary/stats", headers=create_user_auth_headers_for_user(user_data["login"]))
+    assert resp.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_batch_get_users_and_salary_infos(client, create_user_in_database, create_salary_info_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "Admin",
+        "surname": "Admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    user_data = {
+        "user_id": uuid4(),
+        "name": "User",
+        "surname": "User",
+        "email": "user@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "user",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    superuser_data = {
+        "user_id": uuid4(),
+        "name": "Superuser",
+        "surname": "Superuser",
+        "email": "superuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "superuser",
+        "roles": [PortalRole.ROLE_PORTAL_SUPERUSER, ],
+    }
+    for data in (admin_data, user_data, superuser_data):
+        await create_user_in_database(**data)
+    salary_id = uuid4()
+    await create_salary_info_in_database(salary_id, 300.0, "2023-01-01", user_data["user_id"])
+    await create_salary_info_in_database(uuid4(), 500.0, "2023-01-01", superuser_data["user_id"])
+    missing_user_id = uuid4()
+    user_ids = [superuser_data["user_id"], user_data["user_id"], missing_user_id, user_data["user_id"]]
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+
+    resp = client.post(
+        "/user/batch", data=json.dumps({"user_ids": [str(user_id) for user_id in user_ids]}), headers=headers
+    )
+    assert resp.status_code == 200
+    assert_max_queries(resp, 2)
+    results = resp.json()["results"]
+    assert [result["user_id"] for result in results] == [str(user_id) for user_id in user_ids]
+    assert [result["error"] for result in results] == ["forbidden", None, "not_found", None]
+    assert results[1]["user"]["login"] == user_data["login"]
+    assert results[0]["user"] is None
+
+    user_ids = [user_data["user_id"], admin_data["user_id"], superuser_data["user_id"]]
+    resp = client.post(
+        "/user/salary/batch", data=json.dumps({"user_ids": [str(user_id) for user_id in user_ids]}), headers=headers
+    )
+    assert resp.status_code == 200
+    assert_max_queries(resp, 2)
+    results = resp.json()["results"]
+    assert [result["error"] for result in results] == [None, "not_found", "forbidden"]
+    assert results[0]["salary_info"]["salary_id"] == str(salary_id)
+    assert float(results[0]["salary_info"]["salary"]) == 300.0
+
+    resp = client.post("/user/batch", data=json.dumps({"user_ids": []}), headers=headers)
+    assert resp.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reads_of_the_same_user_are_coalesced(create_user_in_database, async_session_test):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "Coalesced",
+        "surname": "Coalesced",
+        "email": "coalesced@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    labels = {"helper": "user_by_id", "outcome": "coalesced"}
+    before = REGISTRY.get_sample_value("single_flight_calls_total", labels) or 0
+    sessions = [async_session_test() for _ in range(5)]
+    try:
+        users = await asyncio.gather(*(_get_user_by_id(user_data["user_id"], session) for session in sessions))
+    finally:
+        for session in sessions:
+            await session.close()
+    assert {user.login for user in users} == {user_data["login"]}
+    assert REGISTRY.get_sample_value("single_flight_calls_total", labels) - before == 4
+
+
+@pytest.mark.asyncio
+async def test_entity_cache_serves_repeat_reads_until_a_write(client, create_user_in_database):
+    user_data = {
+        "user_id": uuid4(),
+        "name": "Cached",
+        "surname": "Cached",
+        "email": "cached@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    headers = create_user_auth_headers_for_user(user_data["login"])
+
+    # a missing salary info is cached too, creating it must invalidate the miss
+    resp = client.get("/user/salary", headers=headers)
+    assert resp.status_code == 404
+    resp = client.post(
+        "/user/salary",
+        data=json.dumps({"user_id": str(user_data["user_id"]), "salary": 100, "next_salary_increase": "2023-02-01"}),
+        headers=headers,
+    )
+    assert resp.status_code == 200
+    salary_id = resp.json()["salary_id"]
+    resp = client.get("/user/salary", headers=headers)
+    assert resp.status_code == 200
+    resp = client.get("/user/salary", headers=headers)
+    assert_max_queries(resp, 0)
+    resp = client.patch(f"/user/salary?salary_id={salary_id}", data=json.dumps({"salary": 400}), headers=headers)
+    assert resp.status_code == 200
+    resp = client.get("/user/salary", headers=headers)
+    assert float(resp.json()["salary"]) == 400.0
+
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.status_code == 200
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.json()["name"] == "Cached"
+    assert_max_queries(resp, 0)
+    resp = client.patch(f"/user/?user_id={user_data['user_id']}", data=json.dumps({"name": "Renamed"}), headers=headers)
+    assert resp.status_code == 200
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=headers)
+    assert resp.json()["name"] == "Renamed"
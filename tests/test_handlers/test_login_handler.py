@@ -0,0 +1,65 @@
+from uuid import uuid4
+
+import pytest
+
+import settings
+from db.models import PortalRole
+from hashing import Hasher
+from tests.conftest import assert_max_queries
+
+
+@pytest.mark.asyncio
+async def test_login_is_throttled_per_login_before_db_work(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "LOGIN_RATE_LIMIT_PER_LOGIN", 3)
+    user_data = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": Hasher.get_password_hash("password"),
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    await create_user_in_database(**user_data)
+    for _ in range(3):
+        resp = client.post("/login/token", data={"username": user_data["login"], "password": "wrong"})
+        assert resp.status_code == 401
+    resp = client.post("/login/token", data={"username": user_data["login"], "password": "password"})
+    assert resp.status_code == 429
+    assert resp.json() == {"detail": "Too many login attempts"}
+    assert 0 < int(resp.headers["Retry-After"]) <= settings.LOGIN_RATE_LIMIT_WINDOW_SECONDS
+    assert_max_queries(resp, 0)
+    # other logins from the same client are still under the per-IP limit
+    resp = client.post("/login/token", data={"username": "another", "password": "password"})
+    assert resp.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_attempts_rejected_per_ip_dont_use_up_the_login_budget(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "LOGIN_RATE_LIMIT_PER_LOGIN", 3)
+    monkeypatch.setattr(settings, "LOGIN_RATE_LIMIT_PER_IP", 2)
+    user_data = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": Hasher.get_password_hash("password"),
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    await create_user_in_database(**user_data)
+    for login in ("another", "yetanother"):
+        resp = client.post("/login/token", data={"username": login, "password": "password"})
+        assert resp.status_code == 401
+    for _ in range(3):
+        resp = client.post("/login/token", data={"username": user_data["login"], "password": "wrong"})
+        assert resp.status_code == 429
+    # once the client is under the per-IP limit again, the login still has all of its attempts
+    monkeypatch.setattr(settings, "LOGIN_RATE_LIMIT_PER_IP", 100)
+    for _ in range(3):
+        resp = client.post("/login/token", data={"username": user_data["login"], "password": "wrong"})
+        assert resp.status_code == 401
+    resp = client.post("/login/token", data={"username": user_data["login"], "password": "password"})
+    assert resp.status_code == 429
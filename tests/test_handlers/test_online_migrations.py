@@ -0,0 +1,83 @@
+from uuid import uuid4
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import settings
+from db.models import Base
+from db.online_migrations import convert_salary_to_numeric, revert_salary_to_float
+
+MIGRATION_SCHEMA = "online_migrations_test"
+
+
+def _run_migration(connection, migration, **kwargs):
+    context = MigrationContext.configure(connection)
+    with Operations.context(context):
+        with context.begin_transaction():
+            migration(**kwargs)
+
+
+@pytest.fixture(scope="function")
+async def migration_engine(monkeypatch):
+    """Tables of their own, a column swap reorders salary_info under the positional inserts of other tests"""
+    monkeypatch.setattr(settings, "SALARY_STATS_MODE", "rollup")
+    engine = create_async_engine(
+        settings.TEST_DATABASE_URL, future=True, connect_args={"server_settings": {"search_path": MIGRATION_SCHEMA}}
+    )
+    async with engine.begin() as connection:
+        await connection.execute(text(f"DROP SCHEMA IF EXISTS {MIGRATION_SCHEMA} CASCADE"))
+        await connection.execute(text(f"CREATE SCHEMA {MIGRATION_SCHEMA}"))
+        await connection.run_sync(Base.metadata.create_all)
+    yield engine
+    async with engine.begin() as connection:
+        await connection.execute(text(f"DROP SCHEMA {MIGRATION_SCHEMA} CASCADE"))
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_convert_salary_to_numeric_keeps_the_stats_trigger(migration_engine):
+    async with migration_engine.connect() as connection:
+        await connection.run_sync(_run_migration, revert_salary_to_float)
+        for i, salary in enumerate((100.004, 1500.5)):
+            user_id = uuid4()
+            await connection.execute(
+                text(
+                    "INSERT INTO users (user_id, name, surname, email, is_active, hashed_password, login, roles) "
+                    "VALUES (:user_id, 'stats', 'stats', :email, true, 'hashed_pass', :login, '{}')"
+                ),
+                {"user_id": user_id, "email": f"stats{i}@gmail.com", "login": f"stats{i}"},
+            )
+            await connection.execute(
+                text(
+                    "INSERT INTO salary_info (salary_id, salary, next_salary_increase, user_id) "
+                    "VALUES (:salary_id, :salary, '2030-01-01', :user_id)"
+                ),
+                {"salary_id": uuid4(), "salary": salary, "user_id": user_id},
+            )
+        await connection.commit()
+
+        await connection.run_sync(_run_migration, convert_salary_to_numeric, batch_size=1)
+        await connection.commit()
+
+        column_type = (await connection.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'salary_info' AND column_name = 'salary'"
+        ))).scalar()
+        assert column_type == "numeric"
+        salaries = (await connection.execute(text("SELECT salary FROM salary_info ORDER BY salary"))).scalars().all()
+        assert [str(salary) for salary in salaries] == ["100.00", "1500.50"]
+        index = (await connection.execute(text(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND indexname = 'ix_salary_info_salary'"
+        ))).scalar()
+        assert index is not None and index.endswith("(salary)")
+
+        # the recreated trigger follows the renamed column
+        await connection.execute(text("UPDATE salary_info SET salary = 2500 WHERE salary = 100"))
+        buckets = (await connection.execute(text(
+            "SELECT bucket, count FROM salary_stats_buckets WHERE count > 0 ORDER BY bucket"
+        ))).all()
+        assert [tuple(bucket) for bucket in buckets] == [(1, 1), (2, 1)]
+        await connection.rollback()
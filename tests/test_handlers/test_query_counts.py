@@ -0,0 +1,54 @@
+import json
+from uuid import uuid4
+
+import pytest
+
+from api.actions.auth import principal_cache
+from db.models import PortalRole
+from tests.conftest import create_user_auth_headers_for_user, assert_max_queries
+
+
+@pytest.mark.asyncio
+async def test_user_router_query_counts(client, create_user_in_database, create_salary_info_in_database):
+    admin_data = {
+        "user_id": uuid4(),
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "admin",
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    user_data = {
+        "user_id": uuid4(),
+        "name": "querycount",
+        "surname": "querycount",
+        "email": "querycount@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**admin_data)
+    await create_user_in_database(**user_data)
+    salary_id = uuid4()
+    await create_salary_info_in_database(salary_id, 300.0, "2023-01-01", admin_data["user_id"])
+    user_id = user_data["user_id"]
+
+    # every request is made with a cold principal cache, so the budgets include the auth lookup
+    requests = [
+        ("get", f"/user/?user_id={user_id}", None, 2),
+        ("get", "/user/salary", None, 2),
+        ("patch", f"/user/?user_id={user_id}", {"name": "Renamed"}, 3),
+        ("post", "/user/salary", {"user_id": str(user_id), "salary": 100, "next_salary_increase": "2023-02-01"}, 3),
+        ("patch", f"/user/salary?salary_id={salary_id}", {"salary": 400}, 2),
+        ("delete", f"/user/salary?salary_id={salary_id}", None, 2),
+        ("delete", f"/user/?user_id={user_id}", None, 3),
+    ]
+    for method, url, body, max_queries in requests:
+        principal_cache.clear()
+        kwargs = {"data": json.dumps(body)} if body is not None else {}
+        resp = client.request(method, url, headers=create_user_auth_headers_for_user(admin_data["login"]), **kwargs)
+        assert resp.status_code == 200, (method, url, resp.json())
+        assert_max_queries(resp, max_queries)
@@ -1,10 +1,15 @@
-
+import json
 from uuid import uuid4
 
+import asyncpg
 import pytest
 
+import cache
+import settings
+from api.actions import auth
 from db.models import PortalRole
-from tests.conftest import create_user_auth_headers_for_user
+from hashing import Hasher
+from tests.conftest import create_user_auth_headers_for_user, assert_max_queries
 
 
 @pytest.mark.asyncio
@@ -47,3 +52,204 @@ async def test_add_admin_role_to_user_by_superuser(
     assert updated_user_from_db["user_id"] == user_data_for_updating["user_id"]
     assert PortalRole.ROLE_PORTAL_ADMIN in updated_user_from_db["roles"]
 
+
+
+@pytest.mark.asyncio
+async def test_promoted_user_gets_admin_rights_without_relogin(
+    client, create_user_in_database, get_user_from_database
+):
+    user_data_for_updating = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    superuser_data = {
+        "user_id": uuid4(),
+        "login": "superuser",
+        "name": "superuser",
+        "surname": "superuser",
+        "email": "superuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_SUPERUSER],
+    }
+    user_for_deletion = {
+        "user_id": uuid4(),
+        "login": "userfordeletion",
+        "name": "userfordeletion",
+        "surname": "userfordeletion",
+        "email": "userfordeletion@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    await create_user_in_database(**superuser_data)
+    await create_user_in_database(**user_data_for_updating)
+    await create_user_in_database(**user_for_deletion)
+    user_headers = create_user_auth_headers_for_user(user_data_for_updating["login"])
+    resp = client.delete(f"/user/?user_id={user_for_deletion['user_id']}", headers=user_headers)
+    assert resp.status_code == 403
+    resp = client.patch(
+        f"/user/admin_privilege?user_id={user_data_for_updating['user_id']}",
+        headers=create_user_auth_headers_for_user(superuser_data["login"]),
+    )
+    assert resp.status_code == 200
+    resp = client.delete(f"/user/?user_id={user_for_deletion['user_id']}", headers=user_headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"deleted_user_id": str(user_for_deletion["user_id"])}
+
+
+@pytest.mark.asyncio
+async def test_stateless_token_is_revoked_by_role_change(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "TOKEN_MODE", "stateless")
+    user_data = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": Hasher.get_password_hash("password"),
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    superuser_data = {
+        "user_id": uuid4(),
+        "login": "superuser",
+        "name": "superuser",
+        "surname": "superuser",
+        "email": "superuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_SUPERUSER],
+    }
+    await create_user_in_database(**user_data)
+    await create_user_in_database(**superuser_data)
+    resp = client.post("/login/token", data={"username": user_data["login"], "password": "password"})
+    assert resp.status_code == 200
+    user_headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=user_headers)
+    assert resp.status_code == 200
+    # the token_version is cached now, the principal comes from the token alone
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=user_headers)
+    assert resp.status_code == 200
+    assert_max_queries(resp, 1)
+
+    resp = client.patch(
+        f"/user/admin_privilege?user_id={user_data['user_id']}",
+        headers=create_user_auth_headers_for_user(superuser_data["login"]),
+    )
+    assert resp.status_code == 200
+    resp = client.get(f"/user/?user_id={user_data['user_id']}", headers=user_headers)
+    assert resp.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_refresh_token_renews_access_until_revoked(client, create_user_in_database):
+    user_data = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": Hasher.get_password_hash("password"),
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    superuser_data = {
+        "user_id": uuid4(),
+        "login": "superuser",
+        "name": "superuser",
+        "surname": "superuser",
+        "email": "superuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_SUPERUSER],
+    }
+    await create_user_in_database(**user_data)
+    await create_user_in_database(**superuser_data)
+    resp = client.post("/login/token", data={"username": user_data["login"], "password": "password"})
+    assert resp.status_code == 200
+    refresh_token = resp.json()["refresh_token"]
+    # a refresh token is not an access token
+    resp = client.get(
+        f"/user/?user_id={user_data['user_id']}", headers={"Authorization": f"Bearer {refresh_token}"}
+    )
+    assert resp.status_code == 401
+
+    resp = client.post("/login/refresh", data=json.dumps({"refresh_token": refresh_token}))
+    assert resp.status_code == 200
+    assert_max_queries(resp, 1)
+    tokens = resp.json()
+    assert tokens["refresh_token"] is None
+    resp = client.get(
+        f"/user/?user_id={user_data['user_id']}", headers={"Authorization": f"Bearer {tokens['access_token']}"}
+    )
+    assert resp.status_code == 200
+
+    resp = client.patch(
+        f"/user/admin_privilege?user_id={user_data['user_id']}",
+        headers=create_user_auth_headers_for_user(superuser_data["login"]),
+    )
+    assert resp.status_code == 200
+    resp = client.post("/login/refresh", data=json.dumps({"refresh_token": refresh_token}))
+    assert resp.status_code == 401
+    assert resp.json() == {"detail": "Invalid refresh token"}
+
+
+@pytest.mark.asyncio
+async def test_principal_read_racing_a_role_change_is_not_cached(client, create_user_in_database, monkeypatch):
+    user_data = {
+        "user_id": uuid4(),
+        "login": "testuser",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    user_for_deletion = {
+        "user_id": uuid4(),
+        "login": "userfordeletion",
+        "name": "userfordeletion",
+        "surname": "userfordeletion",
+        "email": "userfordeletion@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "roles": [PortalRole.ROLE_PORTAL_USER],
+    }
+    await create_user_in_database(**user_data)
+    await create_user_in_database(**user_for_deletion)
+    lookup = auth._get_user_by_login_for_auth
+    promoted = False
+
+    async def lookup_racing_a_promotion(login, db):
+        nonlocal promoted
+        user = await lookup(login, db)
+        if not promoted:
+            # another request promotes the user and commits after this read
+            promoted = True
+            connection = await asyncpg.connect("".join(settings.TEST_DATABASE_URL.split("+asyncpg")))
+            try:
+                await connection.execute(
+                    "UPDATE users SET roles = $1 WHERE user_id = $2",
+                    [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN], user_data["user_id"],
+                )
+            finally:
+                await connection.close()
+            cache.invalidate("user", user.user_id)
+        return user
+
+    monkeypatch.setattr(auth, "_get_user_by_login_for_auth", lookup_racing_a_promotion)
+    user_headers = create_user_auth_headers_for_user(user_data["login"])
+    resp = client.delete(f"/user/?user_id={user_for_deletion['user_id']}", headers=user_headers)
+    assert resp.status_code == 403
+    assert auth.principal_cache.backend.get(user_data["login"]) is None
+    resp = client.delete(f"/user/?user_id={user_for_deletion['user_id']}", headers=user_headers)
+    assert resp.status_code == 200
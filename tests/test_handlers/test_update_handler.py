@@ -1,10 +1,16 @@
+import asyncio
 import json
 import uuid
+from datetime import date
 from uuid import uuid4
 
 import pytest
+from prometheus_client import REGISTRY
 
+import settings
 from db.dals import PortalRole
+from db.entity_cache import user_cache
+from db.invalidation_bus import InvalidationBus
 from tests.conftest import create_user_auth_headers_for_user
 
 
@@ -43,3 +49,270 @@ async def test_update_user(client, create_user_in_database, get_user_from_databa
     assert user_from_db["is_active"] == user_data["is_active"]
     assert str(user_from_db["user_id"]) == str(user_data["user_id"])
 
+
+
+@pytest.mark.asyncio
+async def test_update_salary_info_by_admin(
+        client, create_user_in_database, create_salary_info_in_database, get_salary_info_from_database
+):
+    user_data = {
+        "user_id": uuid4(),
+        "login": "test1",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    salary_id = uuid4()
+    await create_user_in_database(**user_data)
+    await create_user_in_database(**admin_data)
+    await create_salary_info_in_database(salary_id, 300.0, "2022-12-12", user_data["user_id"])
+    resp = client.patch(
+        f"/user/salary?salary_id={salary_id}", data=json.dumps({"salary": 500}),
+        headers=create_user_auth_headers_for_user(admin_data["login"]),
+    )
+    assert resp.status_code == 200
+    assert resp.json() == {"updated_salary_id": str(salary_id)}
+    salary_infos_from_db = await get_salary_info_from_database(salary_id)
+    assert dict(salary_infos_from_db[0])["salary"] == 500
+
+
+@pytest.mark.asyncio
+async def test_update_salary_info_of_another_user_forbidden(
+        client, create_user_in_database, create_salary_info_in_database, get_salary_info_from_database
+):
+    owner_data = {
+        "user_id": uuid4(),
+        "login": "owner",
+        "name": "owner",
+        "surname": "owner",
+        "email": "owner@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    salary_id = uuid4()
+    await create_user_in_database(**owner_data)
+    await create_user_in_database(**admin_data)
+    await create_salary_info_in_database(salary_id, 300.0, "2022-12-12", owner_data["user_id"])
+    resp = client.patch(
+        f"/user/salary?salary_id={salary_id}", data=json.dumps({"salary": 500}),
+        headers=create_user_auth_headers_for_user(admin_data["login"]),
+    )
+    assert resp.status_code == 403
+    salary_infos_from_db = await get_salary_info_from_database(salary_id)
+    assert dict(salary_infos_from_db[0])["salary"] == 300
+    resp = client.patch(
+        f"/user/salary?salary_id={uuid4()}", data=json.dumps({"salary": 500}),
+        headers=create_user_auth_headers_for_user(admin_data["login"]),
+    )
+    assert resp.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upsert_salary_infos_bulk_csv(
+        client, create_user_in_database, create_salary_info_in_database, get_salary_info_from_database
+):
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    user_with_salary_data = {
+        "user_id": uuid4(),
+        "login": "test1",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser1@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    user_without_salary_data = {
+        "user_id": uuid4(),
+        "login": "test2",
+        "name": "testuser",
+        "surname": "testuser",
+        "email": "testuser2@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    salary_id = uuid4()
+    await create_user_in_database(**admin_data)
+    await create_user_in_database(**user_with_salary_data)
+    await create_user_in_database(**user_without_salary_data)
+    await create_salary_info_in_database(salary_id, 300.0, "2022-12-12", user_with_salary_data["user_id"])
+    csv_body = "\n".join([
+        "user_id,salary,next_salary_increase",
+        f"{user_with_salary_data['user_id']},400,2023-06-01",
+        f"{user_without_salary_data['user_id']},500,2023-07-01",
+        f"{uuid4()},600,2023-07-01",
+        f"{user_without_salary_data['user_id']},700,2023-07-01",
+        f"{user_with_salary_data['user_id']},800,01-01-2023",
+    ])
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    headers["Content-Type"] = "text/csv"
+    resp = client.post("/user/salary/bulk", data=csv_body, headers=headers)
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["processed"] == 5
+    assert data_from_resp["upserted"] == 2
+    assert data_from_resp["failed"] == 3
+    assert [error["index"] for error in data_from_resp["errors"]] == [2, 3, 4]
+    assert data_from_resp["errors"][0]["error"] == "User not found"
+    assert data_from_resp["errors"][1]["error"] == "Duplicate user_id in request"
+    salary_infos_from_db = await get_salary_info_from_database(salary_id)
+    assert dict(salary_infos_from_db[0])["salary"] == 400
+    assert dict(salary_infos_from_db[0])["next_salary_increase"] == date(2023, 6, 1)
+
+
+@pytest.mark.asyncio
+async def test_upsert_salary_infos_bulk_accepts_what_the_schema_accepts(
+        client, create_user_in_database, get_salary_info_from_database
+):
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    csv_body = "\n".join([
+        "user_id,salary,next_salary_increase",
+        f"{admin_data['user_id']},1e3,2023-07-01",
+        f"{uuid4()},1e-3,2023-07-01",
+    ])
+    headers["Content-Type"] = "text/csv"
+    resp = client.post("/user/salary/bulk", data=csv_body, headers=headers)
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["upserted"] == 1
+    assert [error["index"] for error in data_from_resp["errors"]] == [1]
+    assert "salary" in data_from_resp["errors"][0]["error"]
+
+    del headers["Content-Type"]
+    resp = client.get("/user/salary", headers=headers)
+    assert resp.status_code == 200
+    salary_id = resp.json()["salary_id"]
+    assert dict((await get_salary_info_from_database(salary_id))[0])["salary"] == 1000
+    # the single-record endpoint takes the same value
+    resp = client.patch(f"/user/salary?salary_id={salary_id}", data=json.dumps({"salary": "2e3"}), headers=headers)
+    assert resp.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_upsert_salary_infos_bulk_stops_reading_at_max_rows(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "BULK_MAX_ROWS", 1)
+    admin_data = {
+        "user_id": uuid4(),
+        "login": "admin",
+        "name": "admin",
+        "surname": "admin",
+        "email": "admin@gmail.com",
+        "hashed_password": "hashed_pass",
+        "is_active": True,
+        "roles": [PortalRole.ROLE_PORTAL_USER, PortalRole.ROLE_PORTAL_ADMIN],
+    }
+    await create_user_in_database(**admin_data)
+    csv_body = "\n".join(
+        ["user_id,salary,next_salary_increase"] + [f"{uuid4()},600,2023-07-01" for _ in range(5)]
+    )
+    headers = create_user_auth_headers_for_user(admin_data["login"])
+    headers["Content-Type"] = "text/csv"
+    resp = client.post("/user/salary/bulk", data=csv_body, headers=headers)
+    assert resp.status_code == 200
+    data_from_resp = resp.json()
+    assert data_from_resp["processed"] == 1
+    assert [error["index"] for error in data_from_resp["errors"]] == [0, 1]
+    assert data_from_resp["errors"][1]["error"].startswith("Bulk limit of 1 records exceeded")
+
+
+async def _wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+@pytest.mark.asyncio
+async def test_invalidation_bus_evicts_entries_of_other_workers(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr(settings, "INVALIDATION_BUS_ENABLED", True)
+    user_data = {
+        "user_id": uuid4(),
+        "name": "Published",
+        "surname": "Published",
+        "email": "published@gmail.com",
+        "is_active": True,
+        "hashed_password": "hashed_pass",
+        "login": "test1",
+        "roles": [PortalRole.ROLE_PORTAL_USER, ],
+    }
+    await create_user_in_database(**user_data)
+    # another worker: its own publisher id, listening on the test database
+    worker = InvalidationBus(
+        dsn="".join(settings.TEST_DATABASE_URL.split("+asyncpg")),
+        channel=settings.INVALIDATION_BUS_CHANNEL,
+        gap_timeout=0.1,
+        reconnect_delay=0.1,
+    )
+    flushes = {"reason": "reconnect"}
+    connected = REGISTRY.get_sample_value("invalidation_bus_flushes_total", flushes) or 0
+    worker.start()
+    try:
+        assert await _wait_for(
+            lambda: (REGISTRY.get_sample_value("invalidation_bus_flushes_total", flushes) or 0) > connected
+        )
+        resp = client.patch(
+            f"/user/?user_id={user_data['user_id']}", data=json.dumps({"name": "Renamed"}),
+            headers=create_user_auth_headers_for_user(user_data["login"]),
+        )
+        assert resp.status_code == 200
+        # stands for the entry the other worker cached before the write, the notification is still queued
+        cache_key = ("user_by_id", user_data["user_id"])
+        user_cache.backend.set(cache_key, "stale", tag=user_data["user_id"])
+        assert await _wait_for(lambda: user_cache.backend.get(cache_key) is None)
+
+        # a notification of another publisher that never arrives makes the worker drop everything
+        notification = {"publisher": "publisher", "events": []}
+        worker._on_notification(None, 0, worker.channel, json.dumps({**notification, "sequence": 1}))
+        worker._on_notification(None, 0, worker.channel, json.dumps({**notification, "sequence": 3}))
+        user_cache.backend.set(cache_key, "stale", tag=user_data["user_id"])
+        assert await _wait_for(lambda: user_cache.backend.get(cache_key) is None)
+        assert REGISTRY.get_sample_value("invalidation_bus_flushes_total", {"reason": "gap"}) >= 1
+    finally:
+        await worker.stop()